@@ -0,0 +1,42 @@
+import os
+import json
+import time
+import logging
+import azure.functions as func
+from shared_code import clients, metrics
+from shared_code.event_queue import Coalescer
+from shared_code.appid_snapshot import appIdSnapshot
+from AutoTagTrigger import processEvent, workerStats
+
+# Events queued by AutoTagTrigger when AUTOTAG_QUEUE_MODE is on. The queue trigger hands messages
+# to this function in batches (see "queues" in host.json) and runs them concurrently on the worker.
+
+# Worker wide, so every message the worker handles is coalesced against the others
+coalescer = Coalescer(float(os.environ.get("AUTOTAG_COALESCE_WINDOW", "30")))
+
+def main(msg: func.QueueMessage) -> None:
+
+    message = json.loads(msg.get_body().decode('utf-8'))
+    body = message['event']
+    resourceUri = body['data'].get('resourceUri', '')
+
+    # A later run for the same resource already saw the change this event reports
+    if resourceUri and coalescer.covered(resourceUri, message['enqueuedAt']):
+        logging.info("Event " + str(body.get('id')) + " was coalesced for: " + resourceUri)
+        return
+
+    # SDK clients are cached per worker and reused between invocations
+    registry = clients.getClients()
+
+    requestMetrics = metrics.begin()
+    appIdSnapshot.refresh(registry)
+    startedAt = time.time()
+    result = processEvent(body, registry.container, registry.resource_client, registry.monitor_client, registry.throttle)
+    # Only a run that returned covers older events, if it raised the retried message must run again
+    if resourceUri:
+        coalescer.processed(resourceUri, startedAt)
+
+    # Failed events are not retried, the same as EventGrid does not redeliver a 400 response.
+    # Unexpected exceptions propagate and the message is retried up to maxDequeueCount.
+    logging.info("Queued event " + str(body.get('id')) + " finished with " + str(result['status']) + " : " + result['message'])
+    logging.info("Request metrics: " + json.dumps(dict(requestMetrics.summary(), worker=workerStats())))
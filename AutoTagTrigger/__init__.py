@@ -1,21 +1,33 @@
+from __future__ import annotations
 import json
 import os
+import sys
 import logging
-from azure.identity import ClientSecretCredential
-from azure.mgmt.resource import ResourceManagementClient
-from azure.mgmt.resource.resources.v2022_09_01.models import TagsResource
-from azure.cosmos import CosmosClient
 import azure.functions as func
-from string import Template
-import datetime
 from datetime import datetime, timedelta
-import smtplib
-from smtplib import SMTPException
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-from azure.mgmt.monitor import MonitorManagementClient
-
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING
+from shared_code import clients
+from shared_code.throttle import ArmThrottle, runThrottled
+from shared_code.appid_lookup import lookupAppId, lookupAppIds
+from shared_code.appid_cache import appIdCache
+from shared_code.appid_snapshot import appIdSnapshot
+from shared_code.api_versions import resolveApiVersion
+from shared_code.event_dedup import eventDeduper
+from shared_code.notifications import failureNotifier
+from shared_code import metrics
+from shared_code.metrics import span, runInContext
+
+# The SDK modules are only needed for annotations here. The clients themselves are imported when
+# shared_code.clients first builds them, which keeps them out of the function's cold start.
+if TYPE_CHECKING:
+    from azure.mgmt.resource import ResourceManagementClient
+    from azure.mgmt.resource.resources.v2022_09_01.models import TagsResource
+    from azure.mgmt.monitor import MonitorManagementClient
+
+# Send `x-autotag-debug: true` to get the per-stage timings of a request back in `x-autotag-metrics`
+DEBUG_HEADER = "x-autotag-debug"
+METRICS_HEADER = "x-autotag-metrics"
 
 # EventGrid can use an HttpTrigger or a classic EventGridTrigger
 # If you want to use a EventGridTrigger
@@ -31,147 +43,304 @@ from azure.mgmt.monitor import MonitorManagementClient
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
 
-    # Turn response body into Python object
+    # Turn response body into Python object. EventGrid delivers an array of events per request.
     req_body = req.get_json()
 
-    # Grab the first object in the response body
-    body = req_body[0]
+    # Answer the EventGrid subscription validation handshake
+    validation = validationResponse(req_body)
+    if validation is not None:
+        return validation
 
-    # The data property holds the main payload. For validation, this contains the validation code
-    data = body['data']
+    # Time every stage of this request
+    requestMetrics = metrics.begin()
+
+    # SDK clients are cached per worker and reused between invocations
+    registry = clients.getClients()
+
+    # In queue mode events are only queued here and AutoTagQueueTrigger tags the resources
+    if queueMode():
+        return enqueueEvents(req_body, registry.event_queue)
+    resource_client = registry.resource_client
+    monitor_client = registry.monitor_client
+    container = registry.container
+
+    # Load the AppId snapshot on the first request and pick up newly published versions
+    appIdSnapshot.refresh(registry)
+
+    # Events for the same resource inside one batch only need to be processed once
+    uniqueEvents, duplicates = dedupeEvents(req_body)
 
+    # Events handled recently, e.g. EventGrid redeliveries, are answered without touching ARM or CosmosDB
+    newEvents, resultsById = claimEvents(uniqueEvents, registry.dedup_container)
+
+    # Run the new events on a bounded worker pool
+    def process(body):
+        resultsById[id(body)] = processEvent(body, container, resource_client, monitor_client, registry.throttle)
+
+    maxConcurrency = max(1, int(os.environ.get("MAX_CONCURRENCY", "8")))
+    try:
+        with ThreadPoolExecutor(max_workers=min(maxConcurrency, len(newEvents)) or 1) as executor:
+            list(executor.map(runInContext(process), newEvents))
+    finally:
+        # Claimed events without a successful result are released, also when processing raised,
+        # so EventGrid's redelivery is processed instead of being answered as a duplicate
+        releaseFailed(newEvents, resultsById, registry.dedup_container)
+    return withMetrics(req, batchResponse(req_body, duplicates, resultsById), requestMetrics)
+
+def workerStats() -> dict:
+    # Worker wide counters since the worker started: AppId cache hits, misses and evictions, and
+    # cold and warm client registry lookups
+    stats = {"appIdCache": appIdCache.stats(), "clients": clients.stats()}
+    # Only loaded with AUTOTAG_ASYNC=true, importing it here would load aiohttp for nothing
+    clientsAio = sys.modules.get("shared_code.clients_aio")
+    if clientsAio is not None:
+        stats["aioClients"] = clientsAio.stats()
+    return stats
+
+def withMetrics(req: func.HttpRequest, response: func.HttpResponse, requestMetrics: metrics.RequestMetrics) -> func.HttpResponse:
+    # Log the per-stage breakdown and the worker counters, and return them in a header when the
+    # caller asks for it
+    summary = json.dumps(dict(requestMetrics.summary(), worker=workerStats()))
+    logging.info("Request metrics: " + summary)
+    if req.headers.get(DEBUG_HEADER, "").lower() == "true":
+        response.headers[METRICS_HEADER] = summary
+    return response
+
+def queueMode() -> bool:
+    return os.environ.get("AUTOTAG_QUEUE_MODE", "false").lower() == "true"
+
+def enqueueEvents(req_body: list, eventQueue: any) -> func.HttpResponse:
+    # Queue every unique event. Messages stay invisible for the coalescing window so the worker
+    # sees a burst of events for one resource after it has settled and only runs once for it.
+    uniqueEvents, duplicates = dedupeEvents(req_body)
+    delay = int(os.environ.get("AUTOTAG_COALESCE_WINDOW", "30"))
+    resultsById = {}
+    failed = False
+    for body in uniqueEvents:
+        # Filtered events, such as the tags/write events our own tag updates raise, are answered
+        # here. Queueing them would only cost a message and a worker run that returns the same 400.
+        filtered = filteredResult(body)
+        if filtered is not None:
+            resultsById[id(body)] = filtered
+            continue
+        try:
+            eventQueue.send(body, delay)
+            resultsById[id(body)] = eventResult(body, 200, "Queued for tagging")
+        except Exception as e:
+            logging.error("Event could not be queued for " + str(body['data'].get('resourceUri')) + " : " + str(e))
+            resultsById[id(body)] = eventResult(body, 500, "Event could not be queued")
+            failed = True
+
+    response = batchResponse(req_body, duplicates, resultsById)
+    if failed:
+        # EventGrid redelivers on 5xx. Events that were queued before are coalesced by the worker.
+        return func.HttpResponse(response.get_body(), status_code=500, mimetype="application/json")
+    return response
+
+def claimEvents(uniqueEvents: list, sharedContainer: any) -> tuple:
+    # Return the events that still need processing and the results of the ones that were seen recently
+    newEvents = []
+    resultsById = {}
+    for body in uniqueEvents:
+        reason = eventDeduper.claim(body, sharedContainer)
+        if reason:
+            resultsById[id(body)] = eventResult(body, 200, "Duplicate event, already processed (" + reason + ")")
+        else:
+            newEvents.append(body)
+
+    if resultsById:
+        logging.info("Answered %d duplicate events, dedup stats: %s" % (len(resultsById), json.dumps(eventDeduper.stats())))
+    return newEvents, resultsById
+
+def releaseFailed(events: list, resultsById: dict, sharedContainer: any):
+    # Failed events are forgotten so a retry or a later event for the resource is processed again
+    for body in events:
+        if resultsById.get(id(body), {}).get('status') != 200:
+            eventDeduper.release(body, sharedContainer)
+
+def validationResponse(req_body: list) -> func.HttpResponse:
     # Validation Process: Creation of EventGrid subscription will send a validationCode.
     # Subscription is validated when the validationCode is returned with a 200 status code response.
-    if 'validationCode' in data:
-        return func.HttpResponse(json.dumps({"validationResponse": data['validationCode']}), status_code=200)
-
-    # Resource Management SDK Appsettings
-    clientId = os.environ.get("CLIENT_ID", None)
-    clientSecret = os.environ.get("CLIENT_SECRET", None)
-    tenantId = os.environ.get("TENANT_ID", None)
-    authority = os.environ.get("AUTHORITY", None)
-    subscriptionId = os.environ.get("SUBSCRIPTION_ID", None)
-
-    # CosmosDB SDK Appsettings
-    url = os.environ.get("COSMOS_URL", None)
-    key = os.environ.get("COSMOS_KEY", None)
-    databaseName = os.environ.get("COSMOS_DATABASE_NAME", None)
-    containerName = os.environ.get("COSMOS_CONTAINER_NAME", None)
-
-    # Instantiate Resource Management Client to query and update tags
-    resource_client = ResourceManagementClient(
-        credential=ClientSecretCredential(tenantId, clientId, clientSecret, authority=authority),
-        subscription_id=subscriptionId,
-        api_version="2020-10-01"
-    )
-
-    monitor_client = MonitorManagementClient(
-        ClientSecretCredential(tenantId, clientId, clientSecret, authority=authority),
-        subscriptionId
-    )
-
-    # Instantiate CosmosDB Client using the url and access key
-    cosmosClient = CosmosClient(url, key)
-
-    # Intantiate CosmosDB Database Client using CosmosDB Client
-    database = cosmosClient.get_database_client(databaseName)
-
-    # Instantiate CosmosDB Container Client using CosmosDB Database Client
-    container = database.get_container_client(containerName)
-
-    if 'operationName' in data:
-            # if 'Microsoft.Resources/tags/write' in data['operationName'] or 'Microsoft.Resources/deployments/write' in data['operationName']:
-            if 'Microsoft.Resources/tags/write' in data['operationName']:
-                logging.info("Operation was filtered for Uri: " + data['resourceUri'] + " | " + data['operationName'])
-                return func.HttpResponse("Operation was filtered for Uri: " + data['resourceUri'] + " | " + data['operationName'], status_code=400)
-
-            # Update tags for a group of deployments such as a multi-resource ARM template
-            if 'Microsoft.Resources/deployments/write' in data['operationName']:
-                # Query for deployment information which contains the list of output resources
+    for body in req_body:
+        if 'validationCode' in body['data']:
+            return func.HttpResponse(json.dumps({"validationResponse": body['data']['validationCode']}), status_code=200)
+    return None
+
+def filteredOperation(data: dict) -> bool:
+    # Events processEvent answers with a 400 without tagging, such as our own tags/write events
+    return 'operationName' not in data or 'Microsoft.Resources/tags/write' in data['operationName']
+
+def filteredResult(body: dict) -> dict:
+    # The 400 result processEvent gives a filtered event, or None when the event is tagged
+    data = body['data']
+
+    if 'operationName' not in data:
+        return eventResult(body, 400, "Event has no operationName")
+
+    # if 'Microsoft.Resources/tags/write' in data['operationName'] or 'Microsoft.Resources/deployments/write' in data['operationName']:
+    if filteredOperation(data):
+        logging.info("Operation was filtered for Uri: " + data['resourceUri'] + " | " + data['operationName'])
+        return eventResult(body, 400, "Operation was filtered for Uri: " + data['resourceUri'] + " | " + data['operationName'])
+    return None
+
+def dedupeEvents(req_body: list) -> tuple:
+    # Return the events to process and a dictionary of id(event) -> id of the event it duplicates.
+    # Filtered events are never used as the original, so a tags/write event does not hide a
+    # write event for the same resource.
+    uniqueEvents = []
+    duplicates = {}
+    seenUris = {}
+    for body in req_body:
+        resourceUri = body['data'].get('resourceUri', '').lower()
+        if filteredOperation(body['data']):
+            uniqueEvents.append(body)
+        elif resourceUri and resourceUri in seenUris:
+            duplicates[id(body)] = seenUris[resourceUri]
+        else:
+            seenUris[resourceUri] = body.get('id')
+            uniqueEvents.append(body)
+    return uniqueEvents, duplicates
+
+def batchResponse(req_body: list, duplicates: dict, resultsById: dict) -> func.HttpResponse:
+    # Build the per-event result in the order the events were delivered
+    results = []
+    for body in req_body:
+        if id(body) in duplicates:
+            results.append(eventResult(body, 200, "Duplicate of event " + str(duplicates[id(body)]) + " in this batch"))
+        else:
+            results.append(resultsById[id(body)])
+
+    # The batch succeeds if at least one event was processed successfully
+    statusCode = 200 if any(result['status'] == 200 for result in results) else 400
+    return func.HttpResponse(json.dumps({"results": results}), status_code=statusCode, mimetype="application/json")
+
+def eventResult(body: dict, status: int, message: str, errors: dict = None) -> dict:
+    result = {
+        "id": body.get('id'),
+        "resourceUri": body['data'].get('resourceUri'),
+        "operationName": body['data'].get('operationName'),
+        "status": status,
+        "message": message
+    }
+    if errors:
+        result["errors"] = errors
+    return result
+
+def processEvent(body: dict, container: any, resource_client: ResourceManagementClient, monitor_client: MonitorManagementClient, throttle: ArmThrottle) -> dict:
+
+    # The data property holds the main payload
+    data = body['data']
+
+    filtered = filteredResult(body)
+    if filtered is not None:
+        return filtered
+
+    # Update tags for a group of deployments such as a multi-resource ARM template
+    if 'Microsoft.Resources/deployments/write' in data['operationName']:
+        try:
+            # Query for deployment information which contains the list of output resources
+            with span("deploymentGet"):
                 existingDeployment = resource_client.resources.get_by_id(data['resourceUri'], '2021-04-01')
+        except Exception as e:
+            logging.error("Deployment could not be read for " + data['resourceUri'] + " : " + str(e))
+            return eventResult(body, 400, "Deployment could not be read for " + data['resourceUri'])
+
+        # Check if the deployment has outputResources. 
+        # outputResources contains the list of resources successfully created via group deployment.
+        outputResources = []
+        if 'outputResources' in existingDeployment.properties:
+            outputResources = existingDeployment.properties.get('outputResources')
+        
+        # Read every output resource, including its tags, in parallel. The throttle adjusts concurrency
+        # to the remaining ARM quota and backs off when ARM answers 429.
+        resourceIds = [resource['id'] for resource in outputResources]
+        existingResources = {}
+        def readOutputResource(resourceId):
+            existingResources[resourceId] = readResource(resourceId, resource_client)
+        failures = runThrottled(throttle, readOutputResource, resourceIds)
+
+        # Resolve the AppIds of the whole deployment in one round-trip so updateTags finds them cached
+        appIds = [appIdFromTags(tags) for _, tags in existingResources.values()]
+        try:
+            lookupAppIds(container, [appId for appId in appIds if appId])
+        except Exception as e:
+            logging.info("AppIds could not be prefetched for " + data['resourceUri'] + " : " + str(e))
+
+        # Read the activity log once per resource group of the output resources instead of once per
+        # resource. Resources whose systemData names the creator do not need it, and updateTags
+        # queries the log of a resource that is missing here on its own.
+        callers = {}
+        for resourceGroup in callerResourceGroups(existingResources):
+            try:
+                callers.update(readCallers(monitor_client, "resourceGroupName eq '%s'" % resourceGroup))
+            except Exception as e:
+                logging.info("Activity log could not be read for resource group " + resourceGroup + " : " + str(e))
+
+        # Tag the output resources in parallel
+        failures.update(runThrottled(
+            throttle,
+            lambda resourceId: updateTags(resourceId, container, resource_client, monitor_client, existingResources[resourceId], callers),
+            list(existingResources.keys())
+        ))
+
+        # Events for the tagged resources that arrive within the dedup TTL are duplicates
+        for resourceId in existingResources.keys() - failures.keys():
+            eventDeduper.remember(resourceId)
+
+        # Create error context from failed tag operations.
+        # This allows us to log any errors while continuing to tag additional resources.
+        errorDict = {resourceId: str(e.args[0]) if e.args else str(e) for resourceId, e in failures.items()}
+
+        # Check if error context is has entries.
+        if errorDict.items():
+            logging.info(str(errorDict))
+            notifyFailures(errorDict)
+            return eventResult(body, 200, "Tag updates failed for some resources in group deployment: " + data['resourceUri'], errorDict)
+
+        # Else if all updates were successful. Error context is empty here.
+        logging.info("All tag updates were successful for group deployment: " + data['resourceUri'])
+        return eventResult(body, 200, "All tag updates were successful for group deployment: " + data['resourceUri'])
+
+    # Update tags for a resource creation using a Service Provider such as 'Microsoft.StorageAccounts/write'
+    try:
+        updateTags(data['resourceUri'], container, resource_client, monitor_client)
+        logging.info("Tag updates were successful for: " + data['resourceUri'])
+        return eventResult(body, 200, "Tag updates were successful for: " + data['resourceUri'])
+    except Exception as e:
+        # Use error raised from updateTags to log and return the error
+        logging.error("Error updating tags for " + data['resourceUri'] + " : " + str(e.args[0]))
+        notifyFailures({data['resourceUri']: str(e.args[0])})
+        return eventResult(body, 400, "Error updating tags for " + data['resourceUri'] + " : " + str(e.args[0]))
+
+def updateTags(resourceUri: str, cosmosClient: any, resourceClient: ResourceManagementClient, monitor_client: MonitorManagementClient, existing: tuple = None, callers: dict = None):
+
+    # The resource and its tags, and the activity log callers, can be passed in when the caller
+    # already read them, e.g. for a group deployment
+    if existing is None:
+        existing = readResource(resourceUri, resourceClient)
+    existingResource, tags = existing
 
-                # Check if the deployment has outputResources. 
-                # outputResources contains the list of resources successfully created via group deployment.
-                if 'outputResources' in existingDeployment.properties:
-                    outputResources = existingDeployment.properties.get('outputResources')
-                
-                # Create empty error context in case of failed tag operations.
-                # This allows us to log any errors while continuing to tag additional resources.
-                errorDict = {}
-                # Iterate through outputResources, applying tags to any valid resources
-                for resource in outputResources:
-                    try:
-                        updateTags(resource['id'], container, resource_client, monitor_client)
-                    except Exception as e:
-                        # Update error context with unsuccessful tag update information
-                        errorDict[resource['id']] = e.args[0]
-
-                # Check if error context is has entries.
-                try:
-                    if errorDict.items():
-                        serializedErrorDict = str(errorDict)
-                        logging.info(serializedErrorDict)
-                        return func.HttpResponse(serializedErrorDict, status_code=200)
-                
-                    # Else if all updates were successful. Error context is empty here.
-                    else:
-                        logging.info("All tag updates were successful for group deployment: " + data['resourceUri'])
-                        return func.HttpResponse("All tag updates were successful for group deployment: " + data['resourceUri'], status_code=200)
-                except Exception as e:
-                    logging.info("Error dictionary could be be rendered for: " + data['resourceUri'])
-                    return func.HttpResponse("Error dictionary could be be rendered for: " + data['resourceUri'], status_code=400)
-
-
-            # Update tags for a resource creation using a Service Provider such as 'Microsoft.StorageAccounts/write'
-            else: 
-                try:
-                    updateTags(data['resourceUri'], container, resource_client, monitor_client)
-                    logging.info("Tag updates were successful for: " + data['resourceUri'])
-                    return func.HttpResponse("Tag updates were successful for: " + data['resourceUri'], status_code=200)
-                except Exception as e:
-                        # Use error raised from updateTags to log and return the error
-                        logging.error("Error updating tags for " + data['resourceUri'] + " : " + e.args[0])
-                        return func.HttpResponse("Error updating tags for " + data['resourceUri'] + " : " + e.args[0], status_code=400)
-
-def updateTags(resourceUri: str, cosmosClient: any, resourceClient: ResourceManagementClient, monitor_client: MonitorManagementClient):
-    existingTags: TagsResource
 
-    try: 
-        existingTags = resourceClient.tags.get_at_scope(resourceUri)
-    except: 
-        raise Exception("Tags are not supported")
     creationDate = 'NA'
     createdBy = 'NA'
     try:
-        existingResource: any
-        try:
-            existingResource = resourceClient.resources.get_by_id(resourceUri, '2021-11-01')
-        except: 
-            existingResource = resourceClient.resources.get_by_id(resourceUri, '2021-04-01')
+        if existingResource is None:
+            raise Exception("Resource could not be read")
 
         if (existingResource.type == "Microsoft.Network/networkInterfaces"):
             parentVirtualMachine = existingResource.properties['virtualMachine']['id']
-            existingResource = resourceClient.resources.get_by_id(parentVirtualMachine, '2021-11-01')
-        
-        if 'systemData' in existingResource.additional_properties:
-            if 'createdAt' in existingResource.additional_properties['systemData']:
-                creationDate = existingResource.additional_properties['systemData']['createdAt']
-            else:
-                creationDate = 'NA'
-            if 'createdBy' in existingResource.additional_properties['systemData']:
-                createdBy = existingResource.additional_properties['systemData']['createdBy']
-            else:
-                createdBy = 'NA'
-
-        if 'timeCreated' in existingResource.properties:
-            creationDate = existingResource.properties['timeCreated']
+            apiVersion = resolveApiVersion(resourceClient, parentVirtualMachine)
+            with span("parentGet"):
+                existingResource = resourceClient.resources.get_by_id(parentVirtualMachine, apiVersion)
+
+        creationDate, createdBy = creationFromResource(existingResource)
         #monitor_client.activity_logs.list("eventTimestamp ge '2014-07-16T04:36:37.6407898Z' and eventTimestamp le '2014-07-20T04:36:37.6407898Z' and resourceUri eq {resourceUri}")
         #formattedCreationDate = datetime.fromisoformat(creationDate)
-        filterQuery = "eventTimestamp ge '%s' and eventTimestamp le '%s' and resourceUri eq '%s'"%((datetime.utcnow() + timedelta(hours=-1)).isoformat()[:-3] + 'Z' , (datetime.utcnow() + timedelta(hours=1)).isoformat()[:-3] + 'Z', resourceUri)
-        result = monitor_client.activity_logs.list(filterQuery)
-        for log in result:
-            if 'bax-creator' not in existingTags.properties.tags or 'NA' in existingTags.properties.tags['bax-creator']:
-                createdBy = log.caller
+        # The activity log is only needed when systemData does not name the creator
+        if createdBy == 'NA' and ('bax-creator' not in tags or 'NA' in tags['bax-creator']):
+            if callers is None or resourceUri.lower() not in callers:
+                callers = readCallers(monitor_client, "resourceUri eq '%s'" % resourceUri)
+            createdBy = callers.get(resourceUri.lower(), createdBy)
 
     except Exception as e:
         logging.info("Error obtained creation properties: " + str(e.args[0]))
@@ -179,7 +348,7 @@ def updateTags(resourceUri: str, cosmosClient: any, resourceClient: ResourceMana
     existingTagsWithInvariantCase: dict[str, str]
     try:
         # Create cloned dictionary with uppercase keys for comparison
-        existingTagsWithInvariantCase = {k.upper():v for k,v in existingTags.properties.tags.items()}
+        existingTagsWithInvariantCase = {k.upper():v for k,v in tags.items()}
     except:
         raise Exception("Could not compare tags")
 
@@ -188,63 +357,130 @@ def updateTags(resourceUri: str, cosmosClient: any, resourceClient: ResourceMana
 
     appIdTagValue = existingTagsWithInvariantCase['APPID']
 
-    # Instantiate empty dictionary to hold queried tagData
-    cosmosTagData = dict[str, any]
-    # Create query template where $n1 is the existing AppId tag value
-    queryTemplate = Template('SELECT * FROM c where c.id = "$n1"')
-
     try:
         # Query for complex tags from CosmosDB using the existing AppId tag
-        for item in cosmosClient.query_items(
-        query=queryTemplate.substitute(n1 = appIdTagValue),
-        enable_cross_partition_query=True,
-        ):
-            
-        # Copy query response into cosmosTagData dictionary
-            cosmosTagData = item.copy()
-
+        cosmosTagData = lookupAppId(cosmosClient, appIdTagValue)
     except Exception as e:
         raise Exception("Cosmos could not query for AppId:" + appIdTagValue)
+
+    if cosmosTagData is None:
+        raise Exception("AppId not found in CosmosDB: " + appIdTagValue)
     
-    # Apply complex tags from CosmosDB
+    # Apply complex tags from CosmosDB. Only tags whose value differs are sent, and nothing is
+    # written when every tag is already up to date, so no follow-up tags/write event is raised.
+    changes = changedTags(existingTagsWithInvariantCase, {
+        "bax-appname": cosmosTagData.get('appName'),
+        "bax-appid": appIdTagValue,
+        "bax-owner": cosmosTagData.get('owner'),
+        "bax-ctime": creationDate,
+        "bax-creator": createdBy
+    })
+    if not changes:
+        logging.info("Tags are already up to date for: " + resourceUri)
+        return
+
     try:
-        existingTags.properties.tags["bax-appname"] = cosmosTagData.get('appName')
-        existingTags.properties.tags["bax-appid"] = appIdTagValue
-        existingTags.properties.tags["bax-owner"] = cosmosTagData.get('owner')
-        existingTags.properties.tags["bax-ctime"] = creationDate
-        existingTags.properties.tags["bax-creator"] = createdBy
-
-        # Update tags at scope
-        resourceClient.tags.create_or_update_at_scope(resourceUri, { "operation": "create", "properties": {
-          "tags": existingTags.properties.tags
-        }})
+        # Merge the changed tags into the existing tags at scope
+        with span("tagWrite"):
+            resourceClient.tags.update_at_scope(resourceUri, { "operation": "Merge", "properties": {
+              "tags": changes
+            }})
     except Exception as e:
         raise Exception("Tag update error")
 
-    
-def sendmail(resourceUri):
-
-    # Email Appsettings
-    sender_email_address = os.environ.get("SENDER_EMAIL_ADDRESS", None)
-    # sender_email_password = os.environ.get("SENDER_EMAIL_PASSWORD", None)
-    receipient_email_address = os.environ.get("RECEIPIENT_EMAIL_ADDRESS", None)
-    smtp_server = os.environ.get("SMTP_SERVER", None)
-    smtp_port = os.environ.get("SMTP_PORT", None)
-
-    msg = MIMEMultipart()
-    msg['From'] = sender_email_address
-    msg['To'] = receipient_email_address
-    msg['Subject'] = 'Unsuccessful Tag Update Operation'
-    message = 'Tag update was unsuccessful for ResourceId: ' + resourceUri
-    msg.attach(MIMEText(message))
-    mailserver = smtplib.SMTP(smtp_server, smtp_port)
-    # identify ourselves to smtp client
-    mailserver.ehlo()
-    # secure our email with tls encryption
-    mailserver.starttls()
-    # re-identify ourselves as an encrypted connection
-    mailserver.ehlo()
-    # mailserver.login(sender_email_address, sender_email_password)
-    mailserver.sendmail(msg['From'], msg['To'], msg.as_string())
-    mailserver.quit()
+def changedTags(existingTagsWithInvariantCase: dict, desiredTags: dict) -> dict:
+    # Return the desired tags whose value differs from the existing one. Tag names are case insensitive.
+    # 'NA' only means the value could not be read this time, so it never replaces an existing value.
+    changes = {}
+    for name, value in desiredTags.items():
+        existingValue = existingTagsWithInvariantCase.get(name.upper())
+        if existingValue != value and not (value == 'NA' and existingValue is not None):
+            changes[name] = value
+    return changes
+
+def readResource(resourceUri: str, resourceClient: ResourceManagementClient) -> tuple:
+    # Return the resource and a copy of its tags. The resource GET already carries the tags, so a
+    # single ARM call is enough. The tags API is only used when the resource itself cannot be read.
+    try:
+        apiVersion = resolveApiVersion(resourceClient, resourceUri)
+        with span("resourceGet"):
+            existingResource = resourceClient.resources.get_by_id(resourceUri, apiVersion)
+        return existingResource, dict(existingResource.tags or {})
+    except Exception as e:
+        logging.info("Resource could not be read for " + resourceUri + ", reading tags at scope: " + str(e))
+        return None, dict(getTags(resourceUri, resourceClient).properties.tags or {})
+
+def creationFromResource(existingResource: any) -> tuple:
+    # Creation date and creator recorded on the resource, 'NA' for anything that is not known
+    creationDate = 'NA'
+    createdBy = 'NA'
+    if 'systemData' in existingResource.additional_properties:
+        if 'createdAt' in existingResource.additional_properties['systemData']:
+            creationDate = existingResource.additional_properties['systemData']['createdAt']
+        if 'createdBy' in existingResource.additional_properties['systemData']:
+            createdBy = existingResource.additional_properties['systemData']['createdBy']
+
+    if existingResource.properties and 'timeCreated' in existingResource.properties:
+        creationDate = existingResource.properties['timeCreated']
+    return creationDate, createdBy
+
+def createdByFromResource(existingResource: any) -> str:
+    # Creator recorded in the resource's systemData, or 'NA' when it is not known
+    if existingResource is None:
+        return 'NA'
+    return creationFromResource(existingResource)[1]
+
+def callerResourceGroups(existingResources: dict) -> list:
+    # Distinct resource groups of the resources whose creator has to be read from the activity log
+    resourceGroups = {}
+    for resourceId, (resource, _) in existingResources.items():
+        resourceGroup = resourceGroupFromUri(resourceId)
+        if resourceGroup and createdByFromResource(resource) == 'NA':
+            resourceGroups.setdefault(resourceGroup.lower(), resourceGroup)
+    return list(resourceGroups.values())
+
+def resourceGroupFromUri(resourceUri: str) -> str:
+    segments = resourceUri.strip('/').split('/')
+    for index, segment in enumerate(segments[:-1]):
+        if segment.lower() == 'resourcegroups':
+            return segments[index + 1]
+    return None
+
+def activityLogFilter(scopeFilter: str) -> str:
+    # Activity log events within an hour either side of now, narrowed down by scopeFilter
+    return "eventTimestamp ge '%s' and eventTimestamp le '%s' and %s"%((datetime.utcnow() + timedelta(hours=-1)).isoformat()[:-3] + 'Z' , (datetime.utcnow() + timedelta(hours=1)).isoformat()[:-3] + 'Z', scopeFilter)
+
+def readCallers(monitor_client: MonitorManagementClient, scopeFilter: str) -> dict:
+    # Index the callers of the activity log by lowercase resourceUri. Later events overwrite
+    # earlier ones, so the last caller of a resource is kept.
+    callers = {}
+    with span("activityLog"):
+        for log in monitor_client.activity_logs.list(activityLogFilter(scopeFilter), select="resourceId,caller"):
+            if log.resource_id and log.caller:
+                callers[log.resource_id.lower()] = log.caller
+    return callers
+
+def getTags(resourceUri: str, resourceClient: ResourceManagementClient) -> TagsResource:
+    try: 
+        with span("tagsGet"):
+            return resourceClient.tags.get_at_scope(resourceUri)
+    except: 
+        raise Exception("Tags are not supported")
+
+def appIdFromTags(tags: dict) -> str:
+    # Tag names are case insensitive, so the AppId tag may be spelled in any case
+    for name, value in tags.items():
+        if name.upper() == 'APPID':
+            return value
+    return None
+
+def notifyFailures(errorDict: dict):
+    # Failures are mailed as one digest per window by a background thread, never from the request
+    for resourceUri, error in errorDict.items():
+        failureNotifier.record("Tag update", resourceUri, error)
+
 
+# AUTOTAG_ASYNC=true serves the trigger from the asyncio implementation in async_pipeline.py,
+# which shares the helpers above. The synchronous main stays the default.
+if os.environ.get("AUTOTAG_ASYNC", "false").lower() == "true":
+    from .async_pipeline import main
@@ -0,0 +1,265 @@
+import os
+import asyncio
+import logging
+import azure.functions as func
+from shared_code import clients, clients_aio
+from shared_code.throttle import ArmThrottle, runThrottledAsync
+from shared_code.appid_lookup import lookupAppIdAsync, lookupAppIdsAsync
+from shared_code.appid_snapshot import appIdSnapshot
+from shared_code.api_versions import resolveApiVersionAsync
+from shared_code.event_dedup import eventDeduper
+from shared_code import metrics
+from shared_code.metrics import span, runInContext
+from . import (
+    eventResult,
+    validationResponse,
+    dedupeEvents,
+    filteredResult,
+    batchResponse,
+    appIdFromTags,
+    creationFromResource,
+    callerResourceGroups,
+    activityLogFilter,
+    queueMode,
+    enqueueEvents,
+    claimEvents,
+    releaseFailed,
+    withMetrics,
+    changedTags,
+    notifyFailures,
+)
+
+# asyncio implementation of the AutoTagTrigger pipeline, enabled with AUTOTAG_ASYNC=true.
+# Every step mirrors the synchronous one in __init__.py and returns the same responses, but runs
+# on the azure.*.aio clients so a worker is never blocked on a single ARM or CosmosDB call.
+
+
+async def main(req: func.HttpRequest) -> func.HttpResponse:
+
+    # Turn response body into Python object. EventGrid delivers an array of events per request.
+    req_body = req.get_json()
+
+    # Answer the EventGrid subscription validation handshake
+    validation = validationResponse(req_body)
+    if validation is not None:
+        return validation
+
+    # In queue mode events are only queued here and AutoTagQueueTrigger tags the resources
+    if queueMode():
+        return await asyncio.get_running_loop().run_in_executor(None, enqueueEvents, req_body, clients.getClients().event_queue)
+
+    # Time every stage of this request. Tasks started by gather inherit the context.
+    requestMetrics = metrics.begin()
+
+    # aio SDK clients are cached per worker and share one aiohttp session
+    registry = await clients_aio.getClients()
+    resource_client = registry.resource_client
+    monitor_client = registry.monitor_client
+    container = registry.container
+
+    # Events for the same resource inside one batch only need to be processed once
+    uniqueEvents, duplicates = dedupeEvents(req_body)
+
+    # Events handled recently are answered right away. The shared dedup store uses the sync
+    # CosmosDB client, so claiming runs off the event loop, as does polling the AppId snapshot.
+    loop = asyncio.get_running_loop()
+    await loop.run_in_executor(None, runInContext(appIdSnapshot.refresh), clients.getClients())
+    dedupContainer = clients.getClients().dedup_container
+    newEvents, resultsById = await loop.run_in_executor(None, runInContext(claimEvents), uniqueEvents, dedupContainer)
+
+    # Run the new events concurrently, at most MAX_CONCURRENCY at a time
+    limit = asyncio.Semaphore(max(1, int(os.environ.get("MAX_CONCURRENCY", "8"))))
+    async def bounded(body):
+        async with limit:
+            resultsById[id(body)] = await processEvent(body, container, resource_client, monitor_client, registry.throttle)
+    try:
+        await asyncio.gather(*[bounded(body) for body in newEvents])
+    finally:
+        # Claimed events without a successful result are released, also when processing raised
+        await loop.run_in_executor(None, runInContext(releaseFailed), newEvents, resultsById, dedupContainer)
+    return withMetrics(req, batchResponse(req_body, duplicates, resultsById), requestMetrics)
+
+
+async def processEvent(body: dict, container: any, resource_client: any, monitor_client: any, throttle: ArmThrottle) -> dict:
+
+    # The data property holds the main payload
+    data = body['data']
+
+    filtered = filteredResult(body)
+    if filtered is not None:
+        return filtered
+
+    # Update tags for a group of deployments such as a multi-resource ARM template
+    if 'Microsoft.Resources/deployments/write' in data['operationName']:
+        try:
+            with span("deploymentGet"):
+                existingDeployment = await resource_client.resources.get_by_id(data['resourceUri'], '2021-04-01')
+        except Exception as e:
+            logging.error("Deployment could not be read for " + data['resourceUri'] + " : " + str(e))
+            return eventResult(body, 400, "Deployment could not be read for " + data['resourceUri'])
+
+        outputResources = []
+        if 'outputResources' in existingDeployment.properties:
+            outputResources = existingDeployment.properties.get('outputResources')
+
+        # Read every output resource concurrently within the ARM throttle
+        resourceIds = [resource['id'] for resource in outputResources]
+        existingResources = {}
+        async def readOutputResource(resourceId):
+            existingResources[resourceId] = await readResource(resourceId, resource_client)
+        failures = await runThrottledAsync(throttle, readOutputResource, resourceIds)
+
+        # Prefetch the AppIds and read the activity log of every resource group of the output
+        # resources at the same time. Resources missing from those logs are queried on their own.
+        appIds = [appIdFromTags(tags) for _, tags in existingResources.values()]
+        resourceGroups = callerResourceGroups(existingResources)
+        prefetched, *groupCallers = await asyncio.gather(
+            lookupAppIdsAsync(container, [appId for appId in appIds if appId]),
+            *[readCallers(monitor_client, "resourceGroupName eq '%s'" % resourceGroup) for resourceGroup in resourceGroups],
+            return_exceptions=True
+        )
+        if isinstance(prefetched, Exception):
+            logging.info("AppIds could not be prefetched for " + data['resourceUri'] + " : " + str(prefetched))
+        callers = {}
+        for resourceGroup, result in zip(resourceGroups, groupCallers):
+            if isinstance(result, Exception):
+                logging.info("Activity log could not be read for resource group " + resourceGroup + " : " + str(result))
+            else:
+                callers.update(result)
+
+        # Tag the output resources concurrently
+        failures.update(await runThrottledAsync(
+            throttle,
+            lambda resourceId: updateTags(resourceId, container, resource_client, monitor_client, existingResources[resourceId], callers),
+            list(existingResources.keys())
+        ))
+
+        for resourceId in existingResources.keys() - failures.keys():
+            eventDeduper.remember(resourceId)
+
+        errorDict = {resourceId: str(e.args[0]) if e.args else str(e) for resourceId, e in failures.items()}
+
+        if errorDict.items():
+            logging.info(str(errorDict))
+            notifyFailures(errorDict)
+            return eventResult(body, 200, "Tag updates failed for some resources in group deployment: " + data['resourceUri'], errorDict)
+
+        logging.info("All tag updates were successful for group deployment: " + data['resourceUri'])
+        return eventResult(body, 200, "All tag updates were successful for group deployment: " + data['resourceUri'])
+
+    # Update tags for a resource creation using a Service Provider such as 'Microsoft.StorageAccounts/write'
+    try:
+        await updateTags(data['resourceUri'], container, resource_client, monitor_client)
+        logging.info("Tag updates were successful for: " + data['resourceUri'])
+        return eventResult(body, 200, "Tag updates were successful for: " + data['resourceUri'])
+    except Exception as e:
+        logging.error("Error updating tags for " + data['resourceUri'] + " : " + str(e.args[0]))
+        notifyFailures({data['resourceUri']: str(e.args[0])})
+        return eventResult(body, 400, "Error updating tags for " + data['resourceUri'] + " : " + str(e.args[0]))
+
+
+async def updateTags(resourceUri: str, container: any, resourceClient: any, monitorClient: any, existing: tuple = None, callers: dict = None):
+
+    if existing is None:
+        existing = await readResource(resourceUri, resourceClient)
+    existingResource, tags = existing
+
+    try:
+        # Create cloned dictionary with uppercase keys for comparison
+        existingTagsWithInvariantCase = {k.upper():v for k,v in tags.items()}
+    except:
+        raise Exception("Could not compare tags")
+
+    if 'APPID' not in existingTagsWithInvariantCase:
+        raise Exception("Valid AppId tag not found")
+
+    appIdTagValue = existingTagsWithInvariantCase['APPID']
+
+    # The creation properties and the CosmosDB lookup do not depend on each other.
+    # readCreation logs and swallows its own errors, so only the lookup can fail here.
+    creation, cosmosTagData = await asyncio.gather(
+        readCreation(resourceUri, existingResource, tags, resourceClient, monitorClient, callers),
+        lookupAppIdAsync(container, appIdTagValue),
+        return_exceptions=True
+    )
+    if isinstance(cosmosTagData, Exception):
+        raise Exception("Cosmos could not query for AppId:" + appIdTagValue)
+    creationDate, createdBy = creation
+
+    if cosmosTagData is None:
+        raise Exception("AppId not found in CosmosDB: " + appIdTagValue)
+
+    # Apply complex tags from CosmosDB. Only tags whose value differs are sent, and nothing is
+    # written when every tag is already up to date, so no follow-up tags/write event is raised.
+    changes = changedTags(existingTagsWithInvariantCase, {
+        "bax-appname": cosmosTagData.get('appName'),
+        "bax-appid": appIdTagValue,
+        "bax-owner": cosmosTagData.get('owner'),
+        "bax-ctime": creationDate,
+        "bax-creator": createdBy
+    })
+    if not changes:
+        logging.info("Tags are already up to date for: " + resourceUri)
+        return
+
+    try:
+        # Merge the changed tags into the existing tags at scope
+        with span("tagWrite"):
+            await resourceClient.tags.update_at_scope(resourceUri, { "operation": "Merge", "properties": {
+              "tags": changes
+            }})
+    except Exception as e:
+        raise Exception("Tag update error")
+
+
+async def readCreation(resourceUri: str, existingResource: any, tags: dict, resourceClient: any, monitorClient: any, callers: dict) -> tuple:
+    # Return the creation date and creator of a resource, 'NA' for anything that could not be read
+    creationDate = 'NA'
+    createdBy = 'NA'
+    try:
+        if existingResource is None:
+            raise Exception("Resource could not be read")
+
+        if (existingResource.type == "Microsoft.Network/networkInterfaces"):
+            parentVirtualMachine = existingResource.properties['virtualMachine']['id']
+            apiVersion = await resolveApiVersionAsync(resourceClient, parentVirtualMachine)
+            with span("parentGet"):
+                existingResource = await resourceClient.resources.get_by_id(parentVirtualMachine, apiVersion)
+
+        creationDate, createdBy = creationFromResource(existingResource)
+        # The activity log is only needed when systemData does not name the creator
+        if createdBy == 'NA' and ('bax-creator' not in tags or 'NA' in tags['bax-creator']):
+            if callers is None or resourceUri.lower() not in callers:
+                callers = await readCallers(monitorClient, "resourceUri eq '%s'" % resourceUri)
+            createdBy = callers.get(resourceUri.lower(), createdBy)
+
+    except Exception as e:
+        logging.info("Error obtained creation properties: " + str(e.args[0] if e.args else e))
+    return creationDate, createdBy
+
+
+async def readResource(resourceUri: str, resourceClient: any) -> tuple:
+    # Return the resource and a copy of its tags, falling back to the tags API like readResource in __init__.py
+    try:
+        apiVersion = await resolveApiVersionAsync(resourceClient, resourceUri)
+        with span("resourceGet"):
+            existingResource = await resourceClient.resources.get_by_id(resourceUri, apiVersion)
+        return existingResource, dict(existingResource.tags or {})
+    except Exception as e:
+        logging.info("Resource could not be read for " + resourceUri + ", reading tags at scope: " + str(e))
+        try:
+            with span("tagsGet"):
+                existingTags = await resourceClient.tags.get_at_scope(resourceUri)
+        except:
+            raise Exception("Tags are not supported")
+        return None, dict(existingTags.properties.tags or {})
+
+
+async def readCallers(monitorClient: any, scopeFilter: str) -> dict:
+    # Index the callers of the activity log by lowercase resourceUri, the last caller of a resource is kept
+    callers = {}
+    with span("activityLog"):
+        async for log in monitorClient.activity_logs.list(activityLogFilter(scopeFilter), select="resourceId,caller"):
+            if log.resource_id and log.caller:
+                callers[log.resource_id.lower()] = log.caller
+    return callers
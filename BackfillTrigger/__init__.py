@@ -0,0 +1,54 @@
+import os
+import json
+import logging
+import azure.functions as func
+from shared_code import clients
+from shared_code.appid_snapshot import appIdSnapshot
+from .backfill import BlobCheckpointStore, runBackfill
+
+# Tags resources that AutoTagTrigger never saw, e.g. ones created before it was deployed or whose
+# events were lost. POST a JSON body such as {"resourceGroup": "rg", "dryRun": true}; leave out
+# resourceGroup to scan the whole subscription. A run that does not finish within
+# BACKFILL_TIME_BUDGET seconds answers 202 and continues from its checkpoint on the next call.
+
+def main(req: func.HttpRequest) -> func.HttpResponse:
+
+    try:
+        options = req.get_json() or {}
+    except ValueError:
+        options = {}
+
+    resourceGroup = options.get('resourceGroup')
+    dryRun = bool(options.get('dryRun', False))
+
+    timeBudget = float(os.environ.get("BACKFILL_TIME_BUDGET", "180"))
+    checkpointContainer = os.environ.get("BACKFILL_CHECKPOINT_CONTAINER", "backfill-checkpoints")
+
+    # SDK clients are cached per worker and reused between invocations
+    registry = clients.getClients()
+
+    # One checkpoint per scope, dry runs keep their own so they never skip resources of a real run
+    checkpointName = "subscription" if not resourceGroup else "resourceGroup-" + resourceGroup.lower()
+    if dryRun:
+        checkpointName += "-dryrun"
+    checkpointName += ".json"
+    checkpoints = BlobCheckpointStore(registry.blob_service_client.get_container_client(checkpointContainer))
+    if options.get('restart'):
+        checkpoints.clear(checkpointName)
+
+    # AppIds are resolved from the published snapshot where possible
+    appIdSnapshot.refresh(registry)
+
+    if resourceGroup:
+        pager = registry.resource_client.resources.list_by_resource_group(resourceGroup)
+    else:
+        pager = registry.resource_client.resources.list()
+
+    try:
+        result = runBackfill(pager, checkpoints, checkpointName, registry.container, registry.resource_client, registry.monitor_client, registry.throttle, dryRun, timeBudget)
+    except Exception as e:
+        logging.error("Backfill failed for " + checkpointName + " : " + str(e))
+        return func.HttpResponse("Backfill failed : " + str(e), status_code=500)
+
+    # 202 tells the caller to call again to continue from the saved checkpoint
+    return func.HttpResponse(json.dumps(result.summary(dryRun)), status_code=200 if result.complete else 202, mimetype="application/json")
@@ -0,0 +1,174 @@
+import json
+import time
+import logging
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from shared_code.throttle import ArmThrottle, runThrottled
+from shared_code.appid_lookup import lookupAppIds
+from AutoTagTrigger import updateTags, appIdFromTags, changedTags
+
+# Number of candidate resources listed in the response. The counts always cover every resource.
+MAX_REPORTED_RESOURCES = 100
+
+# Tags updateTags writes that only need to exist, their values are not derived from CosmosDB
+CREATION_TAGS = ("bax-ctime", "bax-creator")
+
+
+class BlobCheckpointStore:
+    """ Saves backfill progress as small JSON blobs so a run can resume where it stopped. """
+
+    def __init__(self, containerClient):
+        self._container = containerClient
+
+    def ensureContainer(self):
+        # Create the container on the first run, before any resource is tagged, so a checkpoint
+        # can always be saved for the work that was done
+        try:
+            self._container.create_container()
+        except ResourceExistsError:
+            pass
+
+    def load(self, name: str) -> dict:
+        try:
+            return json.loads(self._container.get_blob_client(name).download_blob().readall())
+        except ResourceNotFoundError:
+            return None
+
+    def save(self, name: str, checkpoint: dict):
+        self._container.get_blob_client(name).upload_blob(json.dumps(checkpoint), overwrite=True)
+
+    def clear(self, name: str):
+        try:
+            self._container.get_blob_client(name).delete_blob()
+        except ResourceNotFoundError:
+            pass
+
+
+class BackfillResult:
+
+    def __init__(self, totals: dict = None):
+        # Totals carry over from earlier invocations of the same run
+        totals = totals or {}
+        self.scanned = totals.get("scanned", 0)
+        self.withoutAppId = totals.get("withoutAppId", 0)
+        self.unknownAppId = totals.get("unknownAppId", 0)
+        self.upToDate = totals.get("upToDate", 0)
+        self.candidates = totals.get("candidates", 0)
+        self.tagged = totals.get("tagged", 0)
+        self.failed = totals.get("failed", 0)
+        self.pages = 0
+        self.resources = []
+        self.complete = False
+        self.seconds = 0.0
+
+    def report(self, resourceId: str, reason: str, error: str = None):
+        if len(self.resources) < MAX_REPORTED_RESOURCES:
+            entry = {"id": resourceId, "reason": reason}
+            if error:
+                entry["error"] = error
+            self.resources.append(entry)
+
+    def totals(self) -> dict:
+        return {
+            "scanned": self.scanned,
+            "withoutAppId": self.withoutAppId,
+            "unknownAppId": self.unknownAppId,
+            "upToDate": self.upToDate,
+            "candidates": self.candidates,
+            "tagged": self.tagged,
+            "failed": self.failed,
+        }
+
+    def summary(self, dryRun: bool) -> dict:
+        summary = self.totals()
+        summary.update({
+            "dryRun": dryRun,
+            "complete": self.complete,
+            "pages": self.pages,
+            "seconds": round(self.seconds, 3),
+            "resources": self.resources,
+        })
+        return summary
+
+
+def staleReason(tags: dict, document: dict) -> str:
+    """ Return why a resource with an AppId needs tagging, or None when its bax-* tags are current. """
+    existingTagsWithInvariantCase = {k.upper():v for k,v in tags.items()}
+    appId = existingTagsWithInvariantCase['APPID']
+    changes = changedTags(existingTagsWithInvariantCase, {
+        "bax-appname": document.get('appName'),
+        "bax-appid": appId,
+        "bax-owner": document.get('owner'),
+    })
+    missing = [name for name in CREATION_TAGS if name.upper() not in existingTagsWithInvariantCase]
+    if not changes and not missing:
+        return None
+    names = list(changes.keys()) + missing
+    if all(name.upper() not in existingTagsWithInvariantCase for name in names):
+        return "missing " + ", ".join(names)
+    return "stale " + ", ".join(names)
+
+
+def runBackfill(pager, checkpoints: BlobCheckpointStore, checkpointName: str, container, resourceClient, monitorClient, throttle: ArmThrottle, dryRun: bool, timeBudget: float) -> BackfillResult:
+    """ Tag every listed resource that has an AppId but missing or stale bax-* tags.
+
+        Resources are read one ARM page at a time, so memory does not grow with the subscription.
+        After each page the continuation token is saved, and the run stops once timeBudget seconds
+        have passed. Calling it again with the same checkpoint resumes from the next page. """
+    checkpoints.ensureContainer()
+    checkpoint = checkpoints.load(checkpointName) or {}
+    result = BackfillResult(checkpoint.get("totals"))
+
+    started = time.monotonic()
+    pages = pager.by_page(continuation_token=checkpoint.get("continuationToken"))
+    for page in pages:
+        resources = [(resource.id, dict(resource.tags or {})) for resource in page]
+        result.pages += 1
+        result.scanned += len(resources)
+
+        withAppId = [(resourceId, tags) for resourceId, tags in resources if appIdFromTags(tags)]
+        result.withoutAppId += len(resources) - len(withAppId)
+
+        # Resolve the AppIds of the whole page in as few CosmosDB round-trips as possible
+        documents = lookupAppIds(container, [appIdFromTags(tags) for _, tags in withAppId])
+
+        candidates = []
+        for resourceId, tags in withAppId:
+            document = documents.get(appIdFromTags(tags))
+            if document is None:
+                # updateTags would fail for these, the AppId has to be uploaded first
+                result.unknownAppId += 1
+                result.report(resourceId, "unknown AppId " + appIdFromTags(tags))
+                continue
+            reason = staleReason(tags, document)
+            if reason is None:
+                result.upToDate += 1
+            else:
+                candidates.append(resourceId)
+                result.report(resourceId, reason)
+        result.candidates += len(candidates)
+
+        if not dryRun and candidates:
+            # updateTags reads each resource again, since list results carry no systemData or properties
+            failures = runThrottled(throttle, lambda resourceId: updateTags(resourceId, container, resourceClient, monitorClient), candidates)
+            result.tagged += len(candidates) - len(failures)
+            result.failed += len(failures)
+            for resourceId, e in failures.items():
+                result.report(resourceId, "failed", str(e.args[0]) if e.args else str(e))
+
+        continuationToken = pages.continuation_token
+        if not continuationToken:
+            break
+        checkpoints.save(checkpointName, {"continuationToken": continuationToken, "totals": result.totals()})
+        if time.monotonic() - started > timeBudget:
+            break
+    else:
+        continuationToken = None
+
+    result.seconds = time.monotonic() - started
+    if not continuationToken:
+        result.complete = True
+        checkpoints.clear(checkpointName)
+
+    logging.info("Backfill scanned %d resources in %d pages: %d candidates, %d tagged, %d failed%s" % (
+        result.scanned, result.pages, result.candidates, result.tagged, result.failed, " (dry run)" if dryRun else ""))
+    return result
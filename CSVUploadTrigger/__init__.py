@@ -1,26 +1,12 @@
 import json
 import logging
 import azure.functions as func
-import logging
-from azure.storage.blob import BlobServiceClient
 import os
-from azure.cosmos import CosmosClient
-import smtplib
-from smtplib import SMTPException
-from email.mime.text import MIMEText
-from email.mime.multipart import MIMEMultipart
-from email.mime.application import MIMEApplication
-
-from cryptography.hazmat.primitives.asymmetric.padding import (
-    OAEP,
-    MGF1,
-)
-from cryptography.hazmat.primitives.hashes import SHA1
-from azure.identity import ClientSecretCredential
-
-from azure.keyvault.keys.crypto import CryptographyClient, KeyWrapAlgorithm
-
-from azure.storage.blob import BlobServiceClient
+from shared_code import clients
+from shared_code.appid_snapshot import publishSnapshot, snapshotSettings
+from shared_code.blob_encryption import keyResolver
+from shared_code.notifications import failureNotifier
+from .ingest import ingestCsv
 
 def main(req: func.HttpRequest) -> func.HttpResponse:
 
@@ -39,87 +25,56 @@ def main(req: func.HttpRequest) -> func.HttpResponse:
         return func.HttpResponse(json.dumps({"validationResponse": data['validationCode']}), status_code=200)
 
     # Blob Storage SDK Appsettings 
-    blob_connection_string = os.environ.get("BLOB_CONNECTION_STRING", None)
     blob_container_name = os.environ.get("BLOB_CONTAINER_NAME", None)
-    clientId = os.environ.get("CLIENT_ID", None)
-    clientSecret = os.environ.get("CLIENT_SECRET", None)
-    tenantId = os.environ.get("TENANT_ID", None)
-
-    # CosmosDB SDK Appsettings
-    url = os.environ.get("COSMOS_URL", None)
-    key = os.environ.get("COSMOS_KEY", None)
-    databaseName = os.environ.get("COSMOS_DATABASE_NAME", None)
-    containerName = os.environ.get("COSMOS_CONTAINER_NAME", None)
-
-    credential = ClientSecretCredential(tenantId, clientId, clientSecret)
+    concurrency = max(1, int(os.environ.get("CSV_UPSERT_CONCURRENCY", "16")))
+    # AppIds missing from the uploaded file are only deleted when this is turned on, and never
+    # more than CSV_DELETE_MAX_FRACTION of the table in one upload
+    deleteMissing = os.environ.get("CSV_DELETE_MISSING", "false").lower() == "true"
+    maxDeleteFraction = float(os.environ.get("CSV_DELETE_MAX_FRACTION", "0.1"))
+    # Reject uploads that were not encrypted client-side with the key encryption key
+    requireEncryption = os.environ.get("CSV_REQUIRE_ENCRYPTION", "false").lower() == "true"
 
-    # Instatinate Blob Storage client using connection string
-    blob_service_client = BlobServiceClient.from_connection_string(blob_connection_string, credential=credential)
+    # Blob Storage and CosmosDB clients are cached per worker and reused between invocations
+    registry = clients.getClients()
 
     # Instantiate Blob Storage Container Client using Blob Storage Client
-    container_client = blob_service_client.get_container_client(blob_container_name)
-    # container_client.key_encryption_key = kek
+    container_client = registry.blob_service_client.get_container_client(blob_container_name)
     urlContents = data['url'].split('/')
+    blobName = urlContents[len(urlContents)-1]
     # Instantiate Blob Storage Blob Client using Blob Storage Container Client
-    blob_client = container_client.get_blob_client(urlContents[len(urlContents)-1])
+    blob_client = container_client.get_blob_client(blobName)
 
-    # Download Blob as byte content 
-    data = blob_client.download_blob()
-
-    # Format byte content as string without encoded character. Content is split into an array by line 
-    strContent = data.content_as_text(encoding="utf-8-sig").split("\r\n")
-
-    # Remove first element to account for headers
-    strContent = strContent[1:]
-
-    # Instantiate CosmosDB Client using the url and access key
-    cosmosClient = CosmosClient(url, key)
-
-    # Intantiate CosmosDB Database Client using CosmosDB Client
-    database = cosmosClient.get_database_client(databaseName)
-    
-    # Instantiate CosmosDB Container Client using CosmosDB Database Client
-    container = database.get_container_client(containerName)
+    # Blobs encrypted client-side are decrypted by the storage SDK while they are streamed. The
+    # key encryption key and unwrapped content keys are cached per worker (see blob_encryption).
+    if registry.secret_client is not None:
+        blob_client.key_resolver_function = keyResolver.bind(registry.secret_client)
+        blob_client.require_encryption = requireEncryption
+    elif requireEncryption:
+        logging.error("CSV_REQUIRE_ENCRYPTION is set but KEY_VAULT_URI is not, rejecting " + blobName)
+        return func.HttpResponse("Encrypted uploads are required but no Key Vault is configured", status_code=500)
 
     try:
-    # Iterate through each entry and upsert to CosmosDB
-        for item in strContent:
-            # Filter out lines that don't have any content
-            if len(item) > 0:
-                # Split each row into the set of columns
-                columns = item.split(",")
-                # Perform to upsert to CosmosDB using the CosmosDB Container Client
-                container.upsert_item({"id": columns[0], "appName": columns[1], "owner": columns[2] })
-    except:
-        #sendmail(data.name.split('/')[1])
-        logging.info("mail sent unsuccessful")
-    logging.info('Tag updates were processed for deployment resources')
-    return func.HttpResponse("Tag updates were processed for deployment resources", status_code=200)
-    #sendmail(data.name.split('/')[1])
-    
-
-def sendmail(blobName):
-
-    # Email Appsettings
-    sender_email_address = os.environ.get("SENDER_EMAIL_ADDRESS", None)
-    # sender_email_password = os.environ.get("SENDER_EMAIL_PASSWORD", None)
-    receipient_email_address = os.environ.get("RECEIPIENT_EMAIL_ADDRESS", None)
-    smtp_server = os.environ.get("SMTP_SERVER", None)
-    smtp_port = os.environ.get("SMTP_PORT", None)
-    
-    msg = MIMEMultipart()
-    msg['From'] = sender_email_address
-    msg['To'] = receipient_email_address
-    msg['Subject'] = 'Unsuccessful CosmosDB CSV Update'
-    message = 'CSV tag data update was unsuccessful for Filename: ' + blobName
-    msg.attach(MIMEText(message))
-    mailserver = smtplib.SMTP(smtp_server, smtp_port)
-    # identify ourselves to smtp client
-    mailserver.ehlo()
-    # secure our email with tls encryption
-    mailserver.starttls()
-    # re-identify ourselves as an encrypted connection
-    mailserver.ehlo()
-    # mailserver.login(sender_email_address, sender_email_password)
-    mailserver.sendmail(msg['From'], msg['To'], msg.as_string())
-    mailserver.quit()
\ No newline at end of file
+        # Stream the blob in chunks and write changed rows to CosmosDB as they are parsed
+        result = ingestCsv(blob_client.download_blob().chunks(), registry.container, concurrency, deleteMissing, maxDeleteFraction)
+    except Exception as e:
+        logging.error("CSV ingestion failed for " + blobName + " : " + str(e))
+        failureNotifier.record("CSV ingestion", blobName, str(e))
+        return func.HttpResponse("CSV ingestion failed for " + blobName + " : " + str(e), status_code=400)
+
+    logging.info('Tag data was processed for ' + blobName)
+    summary = result.summary()
+    if result.failed:
+        failureNotifier.record("CSV ingestion", blobName, str(result.failed) + " rows failed, first errors: " + "; ".join(result.errors[:5]))
+
+    # Publish the AppId table for the tagging functions, which read it instead of CosmosDB
+    snapshotContainer, snapshotBlob = snapshotSettings()
+    if snapshotContainer:
+        try:
+            summary["snapshot"] = publishSnapshot(registry.blob_service_client.get_container_client(snapshotContainer), snapshotBlob, registry.container)
+        except Exception as e:
+            # The rows are in CosmosDB, workers keep the previous snapshot and fall back to CosmosDB
+            logging.error("AppId snapshot could not be published: " + str(e))
+            failureNotifier.record("AppId snapshot", blobName, str(e))
+            summary["snapshot"] = {"error": str(e)}
+
+    return func.HttpResponse(json.dumps(summary), status_code=200, mimetype="application/json")
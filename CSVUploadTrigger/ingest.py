@@ -0,0 +1,216 @@
+import io
+import csv
+import json
+import time
+import hashlib
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from shared_code.appid_cache import appIdCache
+from shared_code.appid_lookup import partitionKeyPath, partitionKeyExpression
+
+# Number of row errors kept for the response. The total count is always reported.
+MAX_REPORTED_ERRORS = 20
+
+
+class ChunkReader(io.RawIOBase):
+    """ Read-only file object over an iterator of byte chunks, e.g. StorageStreamDownloader.chunks(). """
+
+    def __init__(self, chunks):
+        self._chunks = iter(chunks)
+        self._buffer = b""
+
+    def readable(self):
+        return True
+
+    def readinto(self, buffer):
+        while not self._buffer:
+            try:
+                self._buffer = next(self._chunks)
+            except StopIteration:
+                return 0
+        size = min(len(buffer), len(self._buffer))
+        buffer[:size] = self._buffer[:size]
+        self._buffer = self._buffer[size:]
+        return size
+
+
+class IngestResult:
+
+    def __init__(self):
+        self.rows = 0
+        self.inserted = 0
+        self.updated = 0
+        self.unchanged = 0
+        self.deleted = 0
+        self.failed = 0
+        self.deleteSkipped = None
+        self.errors = []
+        self.seconds = 0.0
+        self._lock = threading.Lock()
+
+    def fail(self, line: int, message: str):
+        with self._lock:
+            self.failed += 1
+            if len(self.errors) < MAX_REPORTED_ERRORS:
+                self.errors.append("Line " + str(line) + ": " + message)
+
+    @property
+    def rowsPerSecond(self) -> float:
+        return self.rows / self.seconds if self.seconds > 0 else 0.0
+
+    def summary(self) -> dict:
+        return {
+            "rows": self.rows,
+            "inserted": self.inserted,
+            "updated": self.updated,
+            "unchanged": self.unchanged,
+            "deleted": self.deleted,
+            "failed": self.failed,
+            "deleteSkipped": self.deleteSkipped,
+            "seconds": round(self.seconds, 3),
+            "rowsPerSecond": round(self.rowsPerSecond, 1),
+            "errors": self.errors
+        }
+
+
+def readRows(chunks):
+    """ Parse CSV rows from byte chunks without holding the whole file in memory.
+
+        Handles a UTF-8 byte order mark, any line ending and quoted fields. The header row is
+        skipped. Yields (line number, columns) for every row with content. """
+    text = io.TextIOWrapper(io.BufferedReader(ChunkReader(chunks)), encoding="utf-8-sig", newline="")
+    reader = csv.reader(text)
+    # Remove first row to account for headers
+    next(reader, None)
+    for columns in reader:
+        # Filter out lines that don't have any content
+        if any(column.strip() for column in columns):
+            yield reader.line_num, columns
+
+
+def contentHash(appName: str, owner: str) -> str:
+    # Hash of the columns written for an AppId, stored on the document to detect changed rows
+    return hashlib.sha256(json.dumps([appName, owner]).encode("utf-8")).hexdigest()
+
+
+def readIndex(container) -> dict:
+    """ Return a dictionary of AppId to the content hash and partition key of its document.
+
+        Documents written before hashes were stored have a hash of None, so they are rewritten once. """
+    path = partitionKeyPath(container)
+    if path is None:
+        raise Exception("Partition key path of the AppId container could not be read")
+    if path == "/id":
+        return {
+            item['id']: (item.get('contentHash'), item['id'])
+            for item in container.query_items(
+                query="SELECT c.id, c.contentHash FROM c",
+                enable_cross_partition_query=True,
+            )
+        }
+    return {
+        item['id']: (item.get('contentHash'), item.get('partitionKey'))
+        for item in container.query_items(
+            query="SELECT c.id, c.contentHash, " + partitionKeyExpression(path) + " AS partitionKey FROM c",
+            enable_cross_partition_query=True,
+        )
+    }
+
+
+def deleteRefusal(result: IngestResult, missing: int, indexed: int, maxDeleteFraction: float) -> str:
+    # Reason not to delete the AppIds missing from the file, or None when deleting is safe.
+    # A truncated or partly unreadable upload must not empty the AppId table.
+    if result.rows == 0:
+        return "the file has no rows"
+    if result.failed:
+        return str(result.failed) + " rows failed"
+    if missing > indexed * maxDeleteFraction:
+        return "%d of %d AppIds would be deleted, more than CSV_DELETE_MAX_FRACTION allows" % (missing, indexed)
+    return None
+
+
+def ingestCsv(chunks, container, concurrency: int, deleteMissing: bool = False, maxDeleteFraction: float = 0.1) -> IngestResult:
+    """ Write the rows that were inserted or changed since the last upload and, with deleteMissing,
+        delete AppIds that are no longer in the file. Writes run on a bounded pool of concurrent
+        requests; when an AppId repeats, the last row wins. Nothing is deleted when any row failed or the file would remove more than
+        maxDeleteFraction of the table. """
+    result = IngestResult()
+    # Bound the rows waiting for a worker so memory does not grow with the file
+    pending = threading.BoundedSemaphore(concurrency * 4)
+    countLock = threading.Lock()
+
+    try:
+        index = readIndex(container)
+    except Exception as e:
+        # Without the index every row is written and nothing can safely be deleted
+        logging.info("Content hash index could not be read, writing every row: " + str(e))
+        index = {}
+        deleteMissing = False
+
+    def run(line, operation, write):
+        try:
+            write()
+            with countLock:
+                setattr(result, operation, getattr(result, operation) + 1)
+        except Exception as e:
+            result.fail(line, str(e))
+        finally:
+            pending.release()
+
+    def upsert(appId, appName, owner, hash, previous):
+        # Rows for the same AppId are written in file order, so the last row wins like it did
+        # when rows were written one at a time. run never raises, so this only waits.
+        if previous is not None:
+            previous.result()
+        # Perform to upsert to CosmosDB using the CosmosDB Container Client
+        container.upsert_item({"id": appId, "appName": appName, "owner": owner, "contentHash": hash })
+        # Drop the cached copy on this worker so the new values are used right away
+        appIdCache.invalidate([appId])
+
+    def delete(appId, partitionKey):
+        container.delete_item(item=appId, partition_key=partitionKey)
+        appIdCache.invalidate([appId])
+
+    started = time.monotonic()
+    seen = set()
+    # AppId -> (content hash, future) of the last write submitted for it from this file
+    written = {}
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        for line, columns in readRows(chunks):
+            result.rows += 1
+            # Rows that cannot be parsed still count as present so their AppId is not deleted
+            if columns[0]:
+                seen.add(columns[0])
+            if len(columns) < 3:
+                result.fail(line, "Expected 3 columns, found " + str(len(columns)))
+                continue
+
+            appId, appName, owner = columns[0], columns[1], columns[2]
+            hash = contentHash(appName, owner)
+            # A repeated AppId is compared with the row before it, not with the stored document
+            currentHash, previous = written.get(appId, (index[appId][0] if appId in index else None, None))
+            if currentHash == hash:
+                result.unchanged += 1
+                continue
+
+            operation = "updated" if appId in index or appId in written else "inserted"
+            pending.acquire()
+            written[appId] = (hash, executor.submit(run, line, operation, lambda appId=appId, appName=appName, owner=owner, hash=hash, previous=previous: upsert(appId, appName, owner, hash, previous)))
+
+    # Deletes start once every upsert finished, so failed writes are known before anything is removed
+    missing = index.keys() - seen
+    if deleteMissing and missing:
+        result.deleteSkipped = deleteRefusal(result, len(missing), len(index), maxDeleteFraction)
+        if result.deleteSkipped:
+            logging.warning("Not deleting %d AppIds missing from the upload: %s" % (len(missing), result.deleteSkipped))
+        else:
+            with ThreadPoolExecutor(max_workers=concurrency) as executor:
+                for appId in missing:
+                    pending.acquire()
+                    executor.submit(run, 0, "deleted", lambda appId=appId: delete(appId, index[appId][1]))
+    result.seconds = time.monotonic() - started
+
+    logging.info("Ingested %d rows in %.1fs (%.1f rows/s): %d inserted, %d updated, %d unchanged, %d deleted, %d failed" % (
+        result.rows, result.seconds, result.rowsPerSecond, result.inserted, result.updated, result.unchanged, result.deleted, result.failed))
+    return result
@@ -0,0 +1,539 @@
+import re
+import asyncio
+import json
+import time
+import base64
+import random
+import threading
+from types import SimpleNamespace
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from azure.cosmos.exceptions import CosmosResourceNotFoundError, CosmosResourceExistsError
+from shared_code.throttle import ArmThrottle
+from shared_code.event_queue import InProcessEventQueue
+
+# In-memory stand-ins for the Azure SDK clients the functions use. Only the calls the functions
+# make are implemented. Every call goes through a FakeBackend, which adds latency, injects 429
+# responses and counts calls, so the benchmarks measure our code against a predictable backend.
+
+
+class FakeBackend:
+    """ Simulated service: each call sleeps for latency (+/- jitter) and is answered 429 with
+        probability throttleRate. A 429 is retried after retryAfter seconds, like the SDK retry
+        policies do, and is reported to the ArmThrottle when one is attached. """
+
+    def __init__(self, name: str, latency: float = 0.0, jitter: float = 0.0, throttleRate: float = 0.0, retryAfter: float = 0.05, seed: int = 0):
+        self.name = name
+        self.latency = latency
+        self.jitter = jitter
+        self.throttleRate = throttleRate
+        self.retryAfter = retryAfter
+        self.throttle = None
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._counts = {}
+
+    def call(self, operation: str):
+        self._count(operation)
+        while True:
+            with self._lock:
+                delay = max(0.0, self.latency + self._random.uniform(-self.jitter, self.jitter))
+                throttled = self._random.random() < self.throttleRate
+            if delay:
+                time.sleep(delay)
+            if not throttled:
+                if self.throttle is not None:
+                    self.throttle.observe(200, {})
+                return
+            self._count("429")
+            if self.throttle is not None:
+                self.throttle.observe(429, {"Retry-After": str(self.retryAfter)})
+            time.sleep(self.retryAfter)
+
+    def _count(self, operation: str):
+        with self._lock:
+            self._counts[operation] = self._counts.get(operation, 0) + 1
+
+    def reset(self):
+        with self._lock:
+            self._counts.clear()
+
+    def counts(self) -> dict:
+        with self._lock:
+            return {self.name + "." + operation: count for operation, count in self._counts.items()}
+
+
+def _charge(kwargs: dict, requestCharge: float = 1.0):
+    # Answer the CosmosDB response_hook like the SDK does
+    hook = kwargs.get("response_hook")
+    if hook is not None:
+        hook({"x-ms-request-charge": str(requestCharge)}, None)
+
+
+class FakeResource:
+
+    def __init__(self, id: str, type: str, tags: dict = None, properties: dict = None, systemData: dict = None):
+        self.id = id
+        self.type = type
+        self.tags = tags
+        self.properties = properties or {}
+        self.additional_properties = {"systemData": systemData} if systemData else {}
+
+
+class _FakePager:
+    """ ItemPaged stand-in. Continuation tokens are offsets into the list. """
+
+    def __init__(self, backend: FakeBackend, items: list, pageSize: int):
+        self._backend = backend
+        self._items = items
+        self._pageSize = pageSize
+
+    def __iter__(self):
+        for page in self.by_page():
+            yield from page
+
+    def by_page(self, continuation_token: str = None):
+        return _FakePageIterator(self._backend, self._items, self._pageSize, int(continuation_token or 0))
+
+
+class _FakePageIterator:
+
+    def __init__(self, backend: FakeBackend, items: list, pageSize: int, offset: int):
+        self._backend = backend
+        self._items = items
+        self._pageSize = pageSize
+        self._offset = offset
+        self.continuation_token = str(offset) if offset else None
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        if self._offset >= len(self._items):
+            raise StopIteration
+        self._backend.call("resources.list")
+        page = self._items[self._offset:self._offset + self._pageSize]
+        self._offset += len(page)
+        self.continuation_token = str(self._offset) if self._offset < len(self._items) else None
+        return iter(page)
+
+
+class _FakeResources:
+
+    def __init__(self, client):
+        self._client = client
+
+    def get_by_id(self, resourceId: str, apiVersion: str):
+        self._client.backend.call("resources.get_by_id")
+        resource = self._client.store.get(resourceId.lower())
+        if resource is None:
+            raise ResourceNotFoundError("Resource not found: " + resourceId)
+        # Callers get their own copy of the tags, like a real GET
+        return FakeResource(resource.id, resource.type, dict(resource.tags) if resource.tags is not None else None, resource.properties, resource.additional_properties.get("systemData"))
+
+    def list(self):
+        return _FakePager(self._client.backend, [self._copy(resource) for resource in self._client.store.values()], self._client.pageSize)
+
+    def list_by_resource_group(self, resourceGroup: str):
+        marker = "/resourcegroups/" + resourceGroup.lower() + "/"
+        return _FakePager(self._client.backend, [self._copy(resource) for uri, resource in self._client.store.items() if marker in uri], self._client.pageSize)
+
+    @staticmethod
+    def _copy(resource: FakeResource) -> FakeResource:
+        # List results carry tags but no properties or systemData
+        return FakeResource(resource.id, resource.type, dict(resource.tags) if resource.tags is not None else None)
+
+
+class _FakeTags:
+
+    def __init__(self, client):
+        self._client = client
+
+    def get_at_scope(self, scope: str):
+        self._client.backend.call("tags.get_at_scope")
+        resource = self._client.store.get(scope.lower())
+        if resource is None:
+            raise ResourceNotFoundError("Resource not found: " + scope)
+        return SimpleNamespace(properties=SimpleNamespace(tags=dict(resource.tags or {})))
+
+    def update_at_scope(self, scope: str, parameters: dict):
+        self._client.backend.call("tags.update_at_scope")
+        resource = self._client.store.get(scope.lower())
+        if resource is None:
+            raise ResourceNotFoundError("Resource not found: " + scope)
+        with self._client.lock:
+            tags = dict(resource.tags or {})
+            tags.update(parameters["properties"]["tags"])
+            resource.tags = tags
+
+    def create_or_update_at_scope(self, scope: str, parameters: dict):
+        self._client.backend.call("tags.create_or_update_at_scope")
+        resource = self._client.store.get(scope.lower())
+        if resource is None:
+            raise ResourceNotFoundError("Resource not found: " + scope)
+        with self._client.lock:
+            resource.tags = dict(parameters["properties"]["tags"])
+
+
+class _FakeProviders:
+
+    def __init__(self, client):
+        self._client = client
+
+    def get(self, namespace: str):
+        self._client.backend.call("providers.get")
+        resourceTypes = {resource.type.split("/", 1)[1] for resource in self._client.store.values() if resource.type.lower().startswith(namespace.lower() + "/")}
+        return SimpleNamespace(resource_types=[SimpleNamespace(resource_type=resourceType, api_versions=["2023-01-01-preview", "2022-09-01", "2021-04-01"]) for resourceType in sorted(resourceTypes)])
+
+
+class FakeResourceManagementClient:
+    """ ResourceManagementClient backed by a dictionary of lowercase resource id -> FakeResource. """
+
+    def __init__(self, backend: FakeBackend, pageSize: int = 1000):
+        self.backend = backend
+        self.pageSize = pageSize
+        self.store = {}
+        self.lock = threading.Lock()
+        self.resources = _FakeResources(self)
+        self.tags = _FakeTags(self)
+        self.providers = _FakeProviders(self)
+
+    def add(self, resource: FakeResource):
+        self.store[resource.id.lower()] = resource
+
+    def close(self):
+        pass
+
+
+class _FakeActivityLogs:
+
+    FILTER = re.compile(r"(resourceUri|resourceGroupName) eq '([^']*)'")
+
+    def __init__(self, client):
+        self._client = client
+
+    def list(self, filter: str, select: str = None):
+        self._client.backend.call("activity_logs.list")
+        match = self.FILTER.search(filter)
+        if match is None:
+            return []
+        field, value = match.group(1), match.group(2).lower()
+        if field == "resourceUri":
+            return [log for log in self._client.logs if log.resource_id.lower() == value]
+        marker = "/resourcegroups/" + value + "/"
+        return [log for log in self._client.logs if marker in log.resource_id.lower()]
+
+
+class FakeMonitorManagementClient:
+
+    def __init__(self, backend: FakeBackend):
+        self.backend = backend
+        self.logs = []
+        self.activity_logs = _FakeActivityLogs(self)
+
+    def add(self, resourceId: str, caller: str):
+        self.logs.append(SimpleNamespace(resource_id=resourceId, caller=caller))
+
+    def close(self):
+        pass
+
+
+class FakeContainer:
+    """ CosmosDB ContainerProxy over a dictionary of id -> document, partitioned by /id. """
+
+    def __init__(self, backend: FakeBackend, name: str = "appids"):
+        self.backend = backend
+        self.container_link = "dbs/autotag/colls/" + name
+        self.documents = {}
+        self._lock = threading.Lock()
+
+    def read(self, **kwargs):
+        self.backend.call("read")
+        return {"id": self.container_link.rsplit("/", 1)[1], "partitionKey": {"paths": ["/id"], "kind": "Hash"}}
+
+    def read_item(self, item: str, partition_key: str, **kwargs):
+        self.backend.call("read_item")
+        _charge(kwargs)
+        with self._lock:
+            document = self.documents.get(item)
+        if document is None:
+            raise CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+        return dict(document)
+
+    def read_items(self, items: list, **kwargs):
+        self.backend.call("read_items")
+        _charge(kwargs, len(items))
+        with self._lock:
+            return [dict(self.documents[item]) for item, _ in items if item in self.documents]
+
+    def query_items(self, query: str, parameters: list = None, **kwargs):
+        self.backend.call("query_items")
+        with self._lock:
+            documents = list(self.documents.values())
+        _charge(kwargs, 2.5 + len(documents) / 100)
+        if parameters:
+            ids = {parameter["value"] for parameter in parameters}
+            return [dict(document) for document in documents if document["id"] in ids]
+        if "c.contentHash" in query:
+            return [{"id": document["id"], "contentHash": document.get("contentHash")} for document in documents]
+        return [dict(document) for document in documents]
+
+    def upsert_item(self, body: dict, **kwargs):
+        self.backend.call("upsert_item")
+        _charge(kwargs, 10.0)
+        with self._lock:
+            self.documents[body["id"]] = dict(body)
+        return body
+
+    def create_item(self, body: dict, **kwargs):
+        self.backend.call("create_item")
+        _charge(kwargs, 10.0)
+        with self._lock:
+            if body["id"] in self.documents:
+                raise CosmosResourceExistsError(status_code=409, message="Entity with the specified id already exists in the system.")
+            self.documents[body["id"]] = dict(body)
+        return body
+
+    def delete_item(self, item: str, partition_key: str, **kwargs):
+        self.backend.call("delete_item")
+        _charge(kwargs, 10.0)
+        with self._lock:
+            if self.documents.pop(item, None) is None:
+                raise CosmosResourceNotFoundError(status_code=404, message="Entity with the specified id does not exist in the system.")
+
+
+class _FakeDownloader:
+
+    def __init__(self, backend: FakeBackend, data: bytes, chunkSize: int):
+        self._backend = backend
+        self._data = data
+        self._chunkSize = chunkSize
+
+    def chunks(self):
+        for start in range(0, len(self._data), self._chunkSize):
+            self._backend.call("download_chunk")
+            yield self._data[start:start + self._chunkSize]
+
+    def readall(self) -> bytes:
+        return b"".join(self.chunks())
+
+
+def _decryptBlob(data: bytes, encryptionData: dict, keyResolver) -> bytes:
+    # Client-side encryption v2 as the storage SDK writes it: the content key is wrapped with the
+    # key encryption key named by KeyId, the content is AES-GCM encrypted in regions that each
+    # start with their nonce and end with the authentication tag.
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    wrapped = encryptionData["WrappedContentKey"]
+    contentKey = keyResolver(wrapped["KeyId"]).unwrap_key(base64.b64decode(wrapped["EncryptedKey"]), wrapped["Algorithm"])
+    # The SDK prefixes the wrapped key with the protocol version, padded to 8 bytes
+    aesgcm = AESGCM(bytes(contentKey)[8:])
+    regionLength = encryptionData["EncryptedRegionInfo"]["DataLength"]
+    nonceLength = encryptionData["EncryptedRegionInfo"]["NonceLength"]
+    plain = []
+    position = 0
+    while position < len(data):
+        region = data[position:position + nonceLength + regionLength + 16]
+        plain.append(aesgcm.decrypt(region[:nonceLength], region[nonceLength:], None))
+        position += len(region)
+    return b"".join(plain)
+
+
+class _FakeBlobClient:
+
+    def __init__(self, container, name: str):
+        self._container = container
+        self._name = name
+        self.key_resolver_function = None
+        self.require_encryption = False
+
+    def download_blob(self):
+        self._container.backend.call("download_blob")
+        data = self._container.blobs.get(self._name)
+        if data is None:
+            raise ResourceNotFoundError("The specified blob does not exist: " + self._name)
+        encryptionData = self._container.properties[self._name].metadata.get("encryptiondata")
+        if self.require_encryption and not encryptionData:
+            raise ValueError("Encryption required but received data does not contain appropriate metadata.")
+        if encryptionData and self.key_resolver_function is not None:
+            data = _decryptBlob(data, json.loads(encryptionData), self.key_resolver_function)
+        return _FakeDownloader(self._container.backend, data, self._container.chunkSize)
+
+    def upload_blob(self, data, overwrite: bool = False, metadata: dict = None):
+        self._container.backend.call("upload_blob")
+        with self._container.lock:
+            self._container.blobs[self._name] = data.encode("utf-8") if isinstance(data, str) else bytes(data)
+            self._container.etags += 1
+            etag = '"0x' + format(self._container.etags, "X") + '"'
+            self._container.properties[self._name] = SimpleNamespace(etag=etag, metadata=dict(metadata or {}))
+        return {"etag": etag}
+
+    def get_blob_properties(self):
+        self._container.backend.call("get_blob_properties")
+        properties = self._container.properties.get(self._name)
+        if properties is None:
+            raise ResourceNotFoundError("The specified blob does not exist: " + self._name)
+        return properties
+
+    def delete_blob(self):
+        self._container.backend.call("delete_blob")
+        self._container.properties.pop(self._name, None)
+        if self._container.blobs.pop(self._name, None) is None:
+            raise ResourceNotFoundError("The specified blob does not exist: " + self._name)
+
+
+class _FakeBlobContainerClient:
+
+    def __init__(self, backend: FakeBackend, chunkSize: int):
+        self.backend = backend
+        self.chunkSize = chunkSize
+        self.blobs = {}
+        self.properties = {}
+        self.etags = 0
+        self.created = False
+        self.lock = threading.Lock()
+
+    def create_container(self):
+        self.backend.call("create_container")
+        with self.lock:
+            if self.created:
+                raise ResourceExistsError("The specified container already exists.")
+            self.created = True
+
+    def get_blob_client(self, name: str) -> _FakeBlobClient:
+        return _FakeBlobClient(self, name)
+
+
+class FakeBlobServiceClient:
+
+    def __init__(self, backend: FakeBackend, chunkSize: int = 4 * 1024 * 1024):
+        self.backend = backend
+        self.chunkSize = chunkSize
+        self._containers = {}
+
+    def get_container_client(self, name: str) -> _FakeBlobContainerClient:
+        return self._containers.setdefault(name, _FakeBlobContainerClient(self.backend, self.chunkSize))
+
+    def close(self):
+        pass
+
+
+class FakeSecretClient:
+    """ Key Vault secrets, e.g. the key encryption key of encrypted uploads, by name and version. """
+
+    def __init__(self, backend: FakeBackend, vaultUrl: str = "https://fake.vault.azure.net/"):
+        self.backend = backend
+        self.vault_url = vaultUrl
+        self.secrets = {}
+
+    def set_secret(self, name: str, value: str, version: str = "1") -> SimpleNamespace:
+        secret = SimpleNamespace(id=self.vault_url.rstrip("/") + "/secrets/" + name + "/" + version, name=name, value=value)
+        self.secrets[(name, version)] = secret
+        return secret
+
+    def get_secret(self, name: str, version: str = None) -> SimpleNamespace:
+        self.backend.call("get_secret")
+        secret = self.secrets.get((name, version))
+        if secret is None:
+            raise ResourceNotFoundError("A secret with (name/id) " + name + " was not found in this key vault")
+        return secret
+
+    def close(self):
+        pass
+
+
+class FakeRegistry:
+    """ Drop-in for shared_code.clients.ClientRegistry, installed with clients.install. """
+
+    def __init__(self, arm: FakeBackend, monitor: FakeBackend, cosmos: FakeBackend, blob: FakeBackend, maxConcurrency: int = 16, keyvault: FakeBackend = None):
+        self.throttle = ArmThrottle(maxConcurrency)
+        arm.throttle = self.throttle
+        keyvault = keyvault or FakeBackend("keyvault")
+        self.backends = (arm, monitor, cosmos, blob, keyvault)
+        self.resource_client = FakeResourceManagementClient(arm)
+        self.monitor_client = FakeMonitorManagementClient(monitor)
+        self.container = FakeContainer(cosmos)
+        self.blob_service_client = FakeBlobServiceClient(blob)
+        self.event_queue = InProcessEventQueue()
+        self.dedup_container = None
+        # Scenarios with encrypted uploads set secret_client to keyvault
+        self.secret_client = None
+        self.keyvault = FakeSecretClient(keyvault)
+
+    def reset(self):
+        # Forget the calls made while setting up a scenario
+        for backend in self.backends:
+            backend.reset()
+
+    def counts(self) -> dict:
+        counts = {}
+        for backend in self.backends:
+            counts.update(backend.counts())
+        return counts
+
+    def close(self):
+        pass
+
+
+class _AsyncOperations:
+    """ aio view of a fake operation group. Every method is awaitable and runs the synchronous
+        fake on a thread, so backend latency does not block the event loop. """
+
+    def __init__(self, operations):
+        self._operations = operations
+
+    def __getattr__(self, name: str):
+        method = getattr(self._operations, name)
+
+        async def call(*args, **kwargs):
+            return await asyncio.to_thread(method, *args, **kwargs)
+        return call
+
+
+class _AsyncPaged:
+    """ AsyncItemPaged stand-in over a synchronous fake call that returns a list. """
+
+    def __init__(self, method, *args, **kwargs):
+        self._call = lambda: method(*args, **kwargs)
+
+    async def __aiter__(self):
+        for item in await asyncio.to_thread(self._call):
+            yield item
+
+
+class _AsyncActivityLogs:
+
+    def __init__(self, activityLogs: _FakeActivityLogs):
+        self._activityLogs = activityLogs
+
+    def list(self, filter: str, select: str = None):
+        return _AsyncPaged(self._activityLogs.list, filter, select=select)
+
+
+class FakeAsyncContainer(_AsyncOperations):
+    """ azure.cosmos.aio ContainerProxy over a FakeContainer. """
+
+    @property
+    def container_link(self) -> str:
+        return self._operations.container_link
+
+    def query_items(self, query: str, parameters: list = None, **kwargs):
+        return _AsyncPaged(self._operations.query_items, query, parameters, **kwargs)
+
+
+class FakeAsyncRegistry:
+    """ Drop-in for shared_code.clients_aio.AsyncClientRegistry, installed with clients_aio.install.
+
+        Wraps the clients of a FakeRegistry, so both pipelines share the same backends, stores
+        and call counts. """
+
+    def __init__(self, registry: FakeRegistry):
+        self.throttle = registry.throttle
+        self.resource_client = SimpleNamespace(
+            resources=_AsyncOperations(registry.resource_client.resources),
+            tags=_AsyncOperations(registry.resource_client.tags),
+            providers=_AsyncOperations(registry.resource_client.providers),
+        )
+        self.monitor_client = SimpleNamespace(activity_logs=_AsyncActivityLogs(registry.monitor_client.activity_logs))
+        self.container = FakeAsyncContainer(registry.container)
+
+    async def close(self):
+        pass
@@ -0,0 +1,136 @@
+import io
+import os
+import csv
+import json
+import uuid
+import base64
+import random
+from benchmarks.fakes import FakeResource, FakeRegistry
+
+SUBSCRIPTION_ID = "00000000-0000-0000-0000-000000000000"
+
+# Resource types generated for the tenant, with the EventGrid operation that creates them
+RESOURCE_TYPES = (
+    ("Microsoft.Storage/storageAccounts", "Microsoft.Storage/storageAccounts/write"),
+    ("Microsoft.Compute/virtualMachines", "Microsoft.Compute/virtualMachines/write"),
+    ("Microsoft.Network/networkInterfaces", "Microsoft.Network/networkInterfaces/write"),
+    ("Microsoft.Web/sites", "Microsoft.Web/sites/write"),
+)
+
+
+def appIdName(index: int) -> str:
+    return "APP%05d" % index
+
+
+def buildTenant(registry: FakeRegistry, resourceCount: int, appIdCount: int, resourceGroups: int = 10, seed: int = 0) -> list:
+    """ Fill the fake ARM, Monitor and CosmosDB backends with a synthetic subscription.
+
+        Most resources carry an AppId tag, some record their creator in systemData and the rest
+        only in the activity log, and network interfaces point at a virtual machine, so every
+        branch of updateTags is exercised. Returns the (resource id, operation name) pairs. """
+    generator = random.Random(seed)
+
+    for index in range(appIdCount):
+        registry.container.documents[appIdName(index)] = {"id": appIdName(index), "appName": "Application " + str(index), "owner": "owner" + str(index) + "@contoso.com"}
+
+    created = []
+    virtualMachines = []
+    for index in range(resourceCount):
+        resourceType, operationName = RESOURCE_TYPES[index % len(RESOURCE_TYPES)]
+        resourceGroup = "rg-" + str(index % resourceGroups)
+        resourceId = "/subscriptions/%s/resourceGroups/%s/providers/%s/res%06d" % (SUBSCRIPTION_ID, resourceGroup, resourceType, index)
+
+        tags = {"AppId": appIdName(generator.randrange(appIdCount))} if generator.random() < 0.9 else {"env": "dev"}
+        properties = {"timeCreated": "2024-01-01T00:00:00Z"}
+        if resourceType == "Microsoft.Network/networkInterfaces" and virtualMachines:
+            properties["virtualMachine"] = {"id": generator.choice(virtualMachines)}
+        systemData = {"createdAt": "2024-01-01T00:00:00Z", "createdBy": "user@contoso.com"} if generator.random() < 0.7 else None
+
+        registry.resource_client.add(FakeResource(resourceId, resourceType, tags, properties, systemData))
+        if systemData is None:
+            registry.monitor_client.add(resourceId, "deployer@contoso.com")
+        if resourceType == "Microsoft.Compute/virtualMachines":
+            virtualMachines.append(resourceId)
+        created.append((resourceId, operationName))
+
+    return created
+
+
+def addDeployments(registry: FakeRegistry, resources: list, deploymentSize: int) -> list:
+    """ Group resources of the same resource group into deployments. Returns their ids. """
+    byGroup = {}
+    for resourceId, _ in resources:
+        resourceGroup = resourceId.split("/")[4]
+        byGroup.setdefault(resourceGroup, []).append(resourceId)
+
+    deployments = []
+    for resourceGroup, resourceIds in byGroup.items():
+        for start in range(0, len(resourceIds), deploymentSize):
+            deploymentId = "/subscriptions/%s/resourceGroups/%s/providers/Microsoft.Resources/deployments/deploy%d" % (SUBSCRIPTION_ID, resourceGroup, start)
+            outputResources = [{"id": resourceId} for resourceId in resourceIds[start:start + deploymentSize]]
+            registry.resource_client.add(FakeResource(deploymentId, "Microsoft.Resources/deployments", {}, {"outputResources": outputResources}))
+            deployments.append(deploymentId)
+    return deployments
+
+
+def eventGridEvent(resourceUri: str, operationName: str) -> dict:
+    # Shape of a resource write event delivered by an EventGrid subscription on the subscription
+    return {
+        "id": str(uuid.uuid4()),
+        "topic": "/subscriptions/" + SUBSCRIPTION_ID,
+        "subject": resourceUri,
+        "eventType": "Microsoft.Resources.ResourceWriteSuccess",
+        "eventTime": "2024-01-01T00:00:00.0000000Z",
+        "dataVersion": "2",
+        "metadataVersion": "1",
+        "data": {
+            "resourceUri": resourceUri,
+            "operationName": operationName,
+            "status": "Succeeded",
+            "subscriptionId": SUBSCRIPTION_ID,
+        },
+    }
+
+
+def eventBatches(events: list, batchSize: int) -> list:
+    return [events[start:start + batchSize] for start in range(0, len(events), batchSize)]
+
+
+def csvUpload(rows: int, changedEvery: int = 0, seed: int = 0) -> bytes:
+    """ CSV in the format CSVUploadTrigger expects: a header, then AppId, AppName, Owner.
+
+        With changedEvery, every n-th row gets a new owner, to measure a delta re-upload. """
+    generator = random.Random(seed)
+    text = io.StringIO()
+    writer = csv.writer(text, lineterminator="\r\n")
+    writer.writerow(["AppId", "AppName", "Owner"])
+    for index in range(rows):
+        owner = "owner" + str(index) + "@contoso.com"
+        if changedEvery and index % changedEvery == 0:
+            owner = "owner" + str(generator.randrange(rows)) + "@fabrikam.com"
+        writer.writerow([appIdName(index), "Application " + str(index), owner])
+    return ("\ufeff" + text.getvalue()).encode("utf-8")
+
+
+def encryptUpload(data: bytes, keyWrapper) -> tuple:
+    """ Encrypt an upload the way the storage SDK does with client-side encryption v2.
+
+        Returns the encrypted bytes and the blob metadata holding the wrapped content key. """
+    from cryptography.hazmat.primitives.ciphers.aead import AESGCM
+    regionLength = 4 * 1024 * 1024
+    contentKey = os.urandom(32)
+    aesgcm = AESGCM(contentKey)
+    encrypted = []
+    for start in range(0, len(data), regionLength):
+        nonce = os.urandom(12)
+        encrypted.append(nonce + aesgcm.encrypt(nonce, data[start:start + regionLength], None))
+
+    # The protocol version is wrapped together with the content key, padded to 8 bytes
+    wrappedKey = keyWrapper.wrap_key(b"2.0".ljust(8, b"\0") + contentKey)
+    encryptionData = {
+        "WrappedContentKey": {"KeyId": keyWrapper.get_kid(), "EncryptedKey": base64.b64encode(wrappedKey).decode(), "Algorithm": keyWrapper.get_key_wrap_algorithm()},
+        "EncryptionAgent": {"Protocol": "2.0", "EncryptionAlgorithm": "AES_GCM_256"},
+        "EncryptedRegionInfo": {"DataLength": regionLength, "NonceLength": 12},
+        "EncryptionMode": "FullBlob",
+    }
+    return b"".join(encrypted), {"encryptiondata": json.dumps(encryptionData)}
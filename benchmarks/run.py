@@ -0,0 +1,419 @@
+""" Offline throughput benchmarks for AutoTagTrigger, AutoTagQueueTrigger, updateTags and CSVUploadTrigger.
+
+    Runs the functions against the fake backends in benchmarks/fakes.py, so no Azure resources
+    are needed, only the packages in requirements.txt. Run from the repository root:
+
+        python -m benchmarks.run --resources 2000 --arm-latency 0.02 --arm-429-rate 0.01
+
+    Reports throughput, p50/p99 latency per invocation and the calls each backend received. """
+import os
+import sys
+import json
+import base64
+import time
+import logging
+import asyncio
+import argparse
+from concurrent.futures import ThreadPoolExecutor
+
+# App settings read at import time by the functions. Existing values win, so a local.settings
+# style environment can still tune caches and concurrency.
+os.environ.setdefault("AUTOTAG_ASYNC", "false")
+os.environ.setdefault("AUTOTAG_QUEUE_MODE", "false")
+os.environ.setdefault("BLOB_CONTAINER_NAME", "uploads")
+
+import azure.functions as func
+from shared_code import clients, api_versions, appid_lookup
+from shared_code.appid_cache import appIdCache
+from shared_code.appid_snapshot import appIdSnapshot, publishSnapshot, snapshotSettings
+from shared_code.event_dedup import eventDeduper
+from shared_code.blob_encryption import keyResolver
+from shared_code.notifications import failureNotifier
+from shared_code.event_queue import Coalescer
+from benchmarks.fakes import FakeBackend, FakeRegistry, FakeAsyncRegistry
+from benchmarks import payloads
+import AutoTagTrigger
+import AutoTagQueueTrigger
+import CSVUploadTrigger
+
+
+def percentile(values: list, percent: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(percent / 100 * (len(ordered) - 1))))]
+
+
+def buildRegistry(args) -> FakeRegistry:
+    # Every scenario starts from empty backends and cold worker caches
+    appIdCache.invalidate()
+    appIdSnapshot.clear()
+    api_versions.invalidate()
+    appid_lookup.invalidate()
+    eventDeduper.clear()
+    keyResolver.invalidate()
+    registry = FakeRegistry(
+        FakeBackend("arm", args.arm_latency, args.jitter, args.arm_429_rate, args.retry_after, args.seed),
+        FakeBackend("monitor", args.monitor_latency, args.jitter, 0.0, args.retry_after, args.seed),
+        FakeBackend("cosmos", args.cosmos_latency, args.jitter, args.cosmos_429_rate, args.retry_after, args.seed),
+        FakeBackend("blob", args.blob_latency, args.jitter, 0.0, args.retry_after, args.seed),
+        int(os.environ.get("DEPLOYMENT_CONCURRENCY", "16")),
+        FakeBackend("keyvault", args.keyvault_latency, args.jitter, 0.0, args.retry_after, args.seed)
+    )
+    clients.install(registry)
+    return registry
+
+
+def buildTenant(registry: FakeRegistry, args) -> list:
+    resources = payloads.buildTenant(registry, args.resources, args.appids, seed=args.seed)
+    if args.appid_snapshot:
+        # Publish the AppId snapshot the way CSVUploadTrigger does, then forget it so the first
+        # request downloads it like a cold worker would
+        containerName, blobName = snapshotSettings()
+        publishSnapshot(registry.blob_service_client.get_container_client(containerName), blobName, registry.container)
+        appIdSnapshot.clear()
+    return resources
+
+
+def httpRequest(body) -> func.HttpRequest:
+    return func.HttpRequest(method="POST", url="/api/benchmark", headers={}, params={}, body=json.dumps(body).encode("utf-8"))
+
+
+def report(name: str, units: str, count: int, elapsed: float, latencies: list, registry: FakeRegistry) -> dict:
+    return {
+        "scenario": name,
+        units: count,
+        "seconds": round(elapsed, 3),
+        units + "PerSecond": round(count / elapsed, 1) if elapsed > 0 else 0.0,
+        "p50Ms": round(percentile(latencies, 50) * 1000, 2),
+        "p99Ms": round(percentile(latencies, 99) * 1000, 2),
+        "calls": dict(sorted(registry.counts().items())),
+    }
+
+
+def timedCalls(fn, items: list, concurrency: int) -> tuple:
+    # Call fn for every item on a pool and return the wall time and each call's latency
+    def timed(item):
+        started = time.perf_counter()
+        fn(item)
+        return time.perf_counter() - started
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=concurrency) as executor:
+        latencies = list(executor.map(timed, items))
+    return time.perf_counter() - started, latencies
+
+
+def benchmarkEvents(args) -> dict:
+    """ AutoTagTrigger.main with batches of resource write events. """
+    registry = buildRegistry(args)
+    resources = buildTenant(registry, args)
+    events = [payloads.eventGridEvent(resourceId, operationName) for resourceId, operationName in resources]
+    batches = payloads.eventBatches(events, args.batch_size)
+    registry.reset()
+
+    elapsed, latencies = timedCalls(lambda batch: AutoTagTrigger.main(httpRequest(batch)), batches, args.concurrency)
+    return report("autotag-events", "events", len(events), elapsed, latencies, registry)
+
+
+def benchmarkAsync(args, name: str, deployments: bool) -> dict:
+    """ The AUTOTAG_ASYNC=true pipeline with the events or deployments of the sync scenarios.
+
+        The aio clients are the sync fakes run on threads, so the results are comparable. """
+    # Imported here so the other scenarios do not need aiohttp and the aio SDKs
+    from shared_code import clients_aio
+    from AutoTagTrigger import async_pipeline
+
+    registry = buildRegistry(args)
+    resources = buildTenant(registry, args)
+    if deployments:
+        batches = [[payloads.eventGridEvent(deploymentId, "Microsoft.Resources/deployments/write")] for deploymentId in payloads.addDeployments(registry, resources, args.deployment_size)]
+    else:
+        batches = payloads.eventBatches([payloads.eventGridEvent(resourceId, operationName) for resourceId, operationName in resources], args.batch_size)
+    registry.reset()
+
+    async def run():
+        # The fakes sleep on executor threads, which must not be what limits concurrency
+        asyncio.get_running_loop().set_default_executor(ThreadPoolExecutor(max_workers=256))
+        limit = asyncio.Semaphore(args.concurrency)
+        async def timed(batch):
+            async with limit:
+                started = time.perf_counter()
+                await async_pipeline.main(httpRequest(batch))
+                return time.perf_counter() - started
+        started = time.perf_counter()
+        latencies = await asyncio.gather(*[timed(batch) for batch in batches])
+        return time.perf_counter() - started, list(latencies)
+
+    clients_aio.install(FakeAsyncRegistry(registry))
+    try:
+        elapsed, latencies = asyncio.run(run())
+    finally:
+        clients_aio.reset()
+    if deployments:
+        return report(name, "resources", len(resources), elapsed, latencies, registry)
+    return report(name, "events", len(resources), elapsed, latencies, registry)
+
+
+def benchmarkQueue(args) -> dict:
+    """ AutoTagTrigger.main in queue mode, then AutoTagQueueTrigger.main for every queued message.
+
+        Every resource gets two events in separate deliveries, so the second one should be
+        coalesced. Processing the first message raises once; its redelivery must be tagged and
+        not coalesced against the run that failed. """
+    registry = buildRegistry(args)
+    resources = buildTenant(registry, args)
+    AutoTagQueueTrigger.coalescer = Coalescer(AutoTagQueueTrigger.coalescer.window)
+
+    queueMode = os.environ["AUTOTAG_QUEUE_MODE"]
+    os.environ["AUTOTAG_QUEUE_MODE"] = "true"
+    try:
+        rounds = []
+        for _ in range(2):
+            events = [payloads.eventGridEvent(resourceId, operationName) for resourceId, operationName in resources]
+            for batch in payloads.eventBatches(events, args.batch_size):
+                AutoTagTrigger.main(httpRequest(batch))
+            rounds.append(drainQueue(registry.event_queue))
+    finally:
+        os.environ["AUTOTAG_QUEUE_MODE"] = queueMode
+    registry.reset()
+
+    # The host retries a message whose invocation raised, so the first one fails once
+    processEvent = AutoTagQueueTrigger.processEvent
+    failures = []
+
+    def failOnce(body, *clientArgs):
+        if not failures:
+            failures.append(body['data']['resourceUri'])
+            raise RuntimeError("injected failure")
+        return processEvent(body, *clientArgs)
+
+    def handle(message):
+        try:
+            AutoTagQueueTrigger.main(func.QueueMessage(body=message.encode("utf-8")))
+        except RuntimeError:
+            retries.append(message)
+
+    retries = []
+    AutoTagQueueTrigger.processEvent = failOnce
+    try:
+        elapsed, latencies = timedCalls(handle, rounds[0], args.concurrency)
+        armCalls = registry.counts().get("arm.resources.get_by_id", 0)
+        for message in retries:
+            AutoTagQueueTrigger.main(func.QueueMessage(body=message.encode("utf-8")))
+        if registry.counts().get("arm.resources.get_by_id", 0) == armCalls:
+            raise RuntimeError("Retried message was coalesced instead of processed: " + failures[0])
+        elapsed2, latencies2 = timedCalls(handle, rounds[1], args.concurrency)
+    finally:
+        AutoTagQueueTrigger.processEvent = processEvent
+
+    stats = AutoTagQueueTrigger.coalescer.stats()
+    if stats["coalesced"] != len(rounds[1]):
+        raise RuntimeError("Expected %d coalesced events, got %d" % (len(rounds[1]), stats["coalesced"]))
+    result = report("autotag-queue", "events", len(rounds[0]) + len(rounds[1]), elapsed + elapsed2, latencies + latencies2, registry)
+    result["queue"] = dict(stats, queued=len(rounds[0]) + len(rounds[1]), retried=len(retries))
+    return result
+
+
+def drainQueue(eventQueue) -> list:
+    messages = []
+    while True:
+        received = eventQueue.receive()
+        if not received:
+            return messages
+        messages.extend(received)
+
+
+def benchmarkDeployments(args) -> dict:
+    """ AutoTagTrigger.main with deployments/write events for groups of resources. """
+    registry = buildRegistry(args)
+    resources = buildTenant(registry, args)
+    deployments = payloads.addDeployments(registry, resources, args.deployment_size)
+    events = [[payloads.eventGridEvent(deploymentId, "Microsoft.Resources/deployments/write")] for deploymentId in deployments]
+    registry.reset()
+
+    elapsed, latencies = timedCalls(lambda batch: AutoTagTrigger.main(httpRequest(batch)), events, args.concurrency)
+    return report("autotag-deployments", "resources", len(resources), elapsed, latencies, registry)
+
+
+def benchmarkUpdateTags(args) -> dict:
+    """ updateTags called directly for every resource with an AppId. """
+    registry = buildRegistry(args)
+    resources = buildTenant(registry, args)
+    tagged = [resourceId for resourceId, _ in resources if "AppId" in (registry.resource_client.store[resourceId.lower()].tags or {})]
+
+    def update(resourceId):
+        AutoTagTrigger.updateTags(resourceId, registry.container, registry.resource_client, registry.monitor_client)
+
+    elapsed, latencies = timedCalls(update, tagged, args.concurrency)
+    return report("updateTags", "resources", len(tagged), elapsed, latencies, registry)
+
+
+def benchmarkCsv(args, name: str, changedEvery: int) -> dict:
+    """ CSVUploadTrigger.main for a full upload, then for a re-upload with a few changed rows. """
+    registry = buildRegistry(args)
+    container = registry.blob_service_client.get_container_client(os.environ["BLOB_CONTAINER_NAME"])
+    event = [{"data": {"url": "https://account.blob.core.windows.net/uploads/appids.csv"}}]
+
+    container.get_blob_client("appids.csv").upload_blob(payloads.csvUpload(args.csv_rows))
+    if changedEvery:
+        # Load the first upload, then measure the delta upload only
+        CSVUploadTrigger.main(httpRequest(event))
+        container.get_blob_client("appids.csv").upload_blob(payloads.csvUpload(args.csv_rows, changedEvery, args.seed))
+    registry.reset()
+
+    started = time.perf_counter()
+    response = CSVUploadTrigger.main(httpRequest(event))
+    elapsed = time.perf_counter() - started
+    result = report(name, "rows", args.csv_rows, elapsed, [elapsed], registry)
+    result["response"] = json.loads(response.get_body())
+    result["response"].pop("errors", None)
+    return result
+
+
+def benchmarkEncryptedCsv(args) -> dict:
+    """ CSVUploadTrigger.main for a series of client-side encrypted uploads.
+
+        Every upload has its own content key, wrapped with the same key encryption key, so all
+        of them should be served by one Key Vault round-trip. """
+    registry = buildRegistry(args)
+    container = registry.blob_service_client.get_container_client(os.environ["BLOB_CONTAINER_NAME"])
+    registry.secret_client = registry.keyvault
+    secret = registry.keyvault.set_secret(keyResolver.secretName, base64.urlsafe_b64encode(os.urandom(32)).decode())
+    keyWrapper = keyResolver.resolve(registry.keyvault, secret.id)
+    keyResolver.invalidate()
+
+    rows = max(1, args.csv_rows // args.encrypted_uploads)
+    uploads = []
+    for index in range(args.encrypted_uploads):
+        name = "encrypted%03d.csv" % index
+        data, metadata = payloads.encryptUpload(payloads.csvUpload(rows, 1 if index else 0, args.seed + index), keyWrapper)
+        container.get_blob_client(name).upload_blob(data, metadata=metadata)
+        uploads.append([{"data": {"url": "https://account.blob.core.windows.net/uploads/" + name}}])
+    registry.reset()
+
+    def upload(event):
+        response = CSVUploadTrigger.main(httpRequest(event))
+        if response.status_code != 200:
+            raise RuntimeError(response.get_body().decode("utf-8"))
+
+    # Uploads run one after another, like blobs written to the container over time
+    elapsed, latencies = timedCalls(upload, uploads, 1)
+    return report("csv-encrypted-uploads", "rows", rows * len(uploads), elapsed, latencies, registry)
+
+
+def benchmarkNotifications(args) -> dict:
+    """ autotag-events with failure notifications sent to a local SMTP stand-in (aiosmtpd).
+
+        Resources without an AppId fail by design, so a run produces a burst of failures. They
+        should reach the inbox as one digest per window over one SMTP connection. """
+    try:
+        from aiosmtpd.controller import Controller
+    except ImportError:
+        raise SystemExit("The notifications scenario needs aiosmtpd: pip install aiosmtpd")
+
+    class Inbox:
+        def __init__(self):
+            self.connections = 0
+            self.messages = []
+
+        async def handle_EHLO(self, server, session, envelope, hostname, responses):
+            self.connections += 1
+            session.host_name = hostname
+            return responses
+
+        async def handle_DATA(self, server, session, envelope):
+            self.messages.append(envelope.content.decode("utf-8", "replace"))
+            return "250 Message accepted for delivery"
+
+    inbox = Inbox()
+    controller = Controller(inbox, hostname="127.0.0.1", port=args.smtp_port)
+    controller.start()
+    previous = (failureNotifier.settings, failureNotifier.window)
+    failureNotifier.configure({"sender": "autotag@contoso.com", "password": None, "recipient": "ops@contoso.com", "server": "127.0.0.1", "port": args.smtp_port, "starttls": False}, args.notify_window)
+    try:
+        result = benchmarkEvents(args)
+        # Send whatever the last window still holds
+        failureNotifier.flush()
+    finally:
+        failureNotifier.configure(*previous)
+        controller.stop()
+
+    result["scenario"] = "autotag-notifications"
+    result["notifications"] = dict(failureNotifier.stats(), smtpConnections=inbox.connections, mails=len(inbox.messages))
+    return result
+
+
+SCENARIOS = {
+    "events": benchmarkEvents,
+    "events-async": lambda args: benchmarkAsync(args, "autotag-events-async", False),
+    "deployments-async": lambda args: benchmarkAsync(args, "autotag-deployments-async", True),
+    "queue": benchmarkQueue,
+    "deployments": benchmarkDeployments,
+    "updateTags": benchmarkUpdateTags,
+    "csv": lambda args: benchmarkCsv(args, "csv-upload", 0),
+    "csv-delta": lambda args: benchmarkCsv(args, "csv-delta-upload", args.csv_changed_every),
+    "csv-encrypted": benchmarkEncryptedCsv,
+    "notifications": benchmarkNotifications,
+}
+
+# Scenarios with extra requirements only run when asked for
+OPTIONAL_SCENARIOS = ("notifications",)
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Offline throughput benchmarks with fake Azure backends")
+    parser.add_argument("--scenarios", default=",".join(name for name in SCENARIOS if name not in OPTIONAL_SCENARIOS), help="comma separated, from: " + ", ".join(SCENARIOS))
+    parser.add_argument("--resources", type=int, default=1000, help="resources in the synthetic subscription")
+    parser.add_argument("--appids", type=int, default=200, help="AppIds in CosmosDB")
+    parser.add_argument("--batch-size", type=int, default=10, help="events per EventGrid delivery")
+    parser.add_argument("--deployment-size", type=int, default=20, help="output resources per deployment")
+    parser.add_argument("--concurrency", type=int, default=8, help="concurrent invocations")
+    parser.add_argument("--appid-snapshot", action="store_true", help="publish an AppId snapshot so lookups skip CosmosDB")
+    parser.add_argument("--csv-rows", type=int, default=10000)
+    parser.add_argument("--csv-changed-every", type=int, default=100, help="every n-th row changes in the delta upload")
+    parser.add_argument("--encrypted-uploads", type=int, default=20, help="uploads in the csv-encrypted scenario, sharing --csv-rows")
+    parser.add_argument("--smtp-port", type=int, default=8025, help="port of the local SMTP stand-in in the notifications scenario")
+    parser.add_argument("--notify-window", type=float, default=60.0, help="seconds between failure digests in the notifications scenario")
+    parser.add_argument("--arm-latency", type=float, default=0.005, help="seconds per ARM call")
+    parser.add_argument("--monitor-latency", type=float, default=0.01, help="seconds per activity log query")
+    parser.add_argument("--cosmos-latency", type=float, default=0.002, help="seconds per CosmosDB call")
+    parser.add_argument("--blob-latency", type=float, default=0.002, help="seconds per blob call")
+    parser.add_argument("--keyvault-latency", type=float, default=0.05, help="seconds per Key Vault call")
+    parser.add_argument("--jitter", type=float, default=0.0, help="+/- seconds added to every call")
+    parser.add_argument("--arm-429-rate", type=float, default=0.0, help="fraction of ARM calls answered 429")
+    parser.add_argument("--cosmos-429-rate", type=float, default=0.0, help="fraction of CosmosDB calls answered 429")
+    parser.add_argument("--retry-after", type=float, default=0.05, help="Retry-After seconds of injected 429s")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    parser.add_argument("--verbose", action="store_true", help="show the functions' log output")
+    args = parser.parse_args(argv)
+
+    # Resources without an AppId are logged as errors by design, which would drown the report
+    logging.basicConfig(level=logging.INFO if args.verbose else logging.CRITICAL)
+
+    results = []
+    try:
+        for name in args.scenarios.split(","):
+            if name not in SCENARIOS:
+                parser.error("unknown scenario: " + name)
+            results.append(SCENARIOS[name](args))
+    finally:
+        clients.reset()
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        units = [key for key in result if key.endswith("PerSecond")][0]
+        print("%-22s %8.1f %-18s p50 %8.2f ms  p99 %8.2f ms  (%.2fs)" % (result["scenario"], result[units], units, result["p50Ms"], result["p99Ms"], result["seconds"]))
+        for call, count in result["calls"].items():
+            print("    %-40s %d" % (call, count))
+        for section in ("queue", "notifications"):
+            for name, value in result.get(section, {}).items():
+                print("    %-40s %d" % (section + "." + name, value))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
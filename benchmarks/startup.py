@@ -0,0 +1,81 @@
+""" Cold start import time of each function module.
+
+    Every sample imports the module in a fresh interpreter, the way a new worker loads a function,
+    and reports the median. Run from the repository root:
+
+        python -m benchmarks.startup --runs 7 --top 10
+
+    With --top, the slowest modules of one `python -X importtime` run are listed as well. """
+import os
+import sys
+import json
+import argparse
+import statistics
+import subprocess
+
+FUNCTIONS = ("AutoTagTrigger", "AutoTagQueueTrigger", "CSVUploadTrigger", "BackfillTrigger")
+
+# Prints the seconds spent importing the module given as the first argument
+TIMER = "import sys, time; started = time.perf_counter(); __import__(sys.argv[1]); print(time.perf_counter() - started)"
+
+
+def importSeconds(module: str, env: dict) -> float:
+    output = subprocess.run([sys.executable, "-c", TIMER, module], env=env, capture_output=True, text=True, check=True)
+    return float(output.stdout.strip().splitlines()[-1])
+
+
+def slowestImports(module: str, env: dict, count: int) -> list:
+    """ The modules with the largest cumulative import time, from -X importtime. """
+    output = subprocess.run([sys.executable, "-X", "importtime", "-c", "import " + module], env=env, capture_output=True, text=True, check=True)
+    timings = []
+    for line in output.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "cumulative" in line:
+            continue
+        _, cumulative, name = line[len("import time:"):].split("|")
+        # Nested imports are indented and already part of their parent's time, so only the
+        # imports made directly by the function or by shared_code are listed
+        depth = len(name) - len(name.lstrip())
+        if depth <= 3 or name.strip().startswith("shared_code"):
+            timings.append((int(cumulative), name.strip()))
+    return [{"module": name, "ms": round(microseconds / 1000, 1)} for microseconds, name in sorted(timings, reverse=True)[:count]]
+
+
+def main(argv: list = None):
+    parser = argparse.ArgumentParser(description="Import time of each function module in a fresh interpreter")
+    parser.add_argument("--functions", default=",".join(FUNCTIONS), help="comma separated, from: " + ", ".join(FUNCTIONS))
+    parser.add_argument("--runs", type=int, default=5, help="fresh interpreters per function")
+    parser.add_argument("--top", type=int, default=0, help="also list the n slowest imports of each function")
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args(argv)
+
+    # Same settings as benchmarks.run, so the synchronous pipeline is measured
+    env = dict(os.environ)
+    env.setdefault("AUTOTAG_ASYNC", "false")
+    env.setdefault("BLOB_CONTAINER_NAME", "uploads")
+    env["PYTHONPATH"] = os.pathsep.join(filter(None, [os.getcwd(), env.get("PYTHONPATH")]))
+
+    results = []
+    for function in args.functions.split(","):
+        if function not in FUNCTIONS:
+            parser.error("unknown function: " + function)
+        # One discarded run so every sample reads compiled bytecode
+        importSeconds(function, env)
+        samples = [importSeconds(function, env) for _ in range(args.runs)]
+        result = {"function": function, "medianMs": round(statistics.median(samples) * 1000, 1), "minMs": round(min(samples) * 1000, 1)}
+        if args.top:
+            result["slowest"] = slowestImports(function, env, args.top)
+        results.append(result)
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    for result in results:
+        print("%-22s median %8.1f ms  min %8.1f ms" % (result["function"], result["medianMs"], result["minMs"]))
+        for entry in result.get("slowest", []):
+            print("    %-40s %8.1f ms" % (entry["module"], entry["ms"]))
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,2 @@
+# Helpers shared between the functions in this app.
+# Function folders import from here with an absolute import, e.g. `from shared_code import clients`.
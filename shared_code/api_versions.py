@@ -0,0 +1,117 @@
+from __future__ import annotations
+import asyncio
+import logging
+import weakref
+import threading
+from typing import TYPE_CHECKING
+from shared_code.metrics import span
+
+if TYPE_CHECKING:
+    from azure.mgmt.resource import ResourceManagementClient
+
+# Used when the resource provider cannot be read or does not list the resource type
+DEFAULT_API_VERSION = "2021-04-01"
+
+# Worker wide cache of provider namespace -> {resource type: API version}. Provider API versions
+# only change when a provider ships a new version, so entries are kept for the life of the worker.
+_providers = {}
+_lock = threading.Lock()
+
+# One lock per namespace, so on a cold worker only one caller reads a provider and the others
+# wait for its result instead of repeating the ARM call. The async pipeline keeps its own locks
+# per event loop, since an asyncio.Lock belongs to one loop.
+_namespaceLocks = {}
+_asyncNamespaceLocks = weakref.WeakKeyDictionary()
+
+
+def parseResourceType(resourceUri: str) -> tuple:
+    """ Return the (namespace, resource type) of a resource id, e.g.
+        /subscriptions/x/resourceGroups/rg/providers/Microsoft.Network/networkInterfaces/nic
+        -> ("microsoft.network", "networkinterfaces"). Both are lowercase. """
+    segments = [segment for segment in resourceUri.strip("/").split("/") if segment]
+    lowered = [segment.lower() for segment in segments]
+
+    if "providers" not in lowered:
+        # Resource groups and subscriptions belong to Microsoft.Resources
+        if "resourcegroups" in lowered:
+            return "microsoft.resources", "resourcegroups"
+        return "microsoft.resources", "subscriptions"
+
+    # Extension resources nest providers, the last one owns the resource
+    start = len(lowered) - 1 - lowered[::-1].index("providers")
+    namespace = lowered[start + 1]
+    # The remaining segments alternate between type and name
+    types = lowered[start + 2::2]
+    return namespace, "/".join(types)
+
+
+def _versionsOf(provider) -> dict:
+    versions = {}
+    for resourceType in provider.resource_types or []:
+        apiVersions = resourceType.api_versions or []
+        if not apiVersions:
+            continue
+        # Providers list versions newest first. Prefer the newest stable version.
+        stable = [version for version in apiVersions if "preview" not in version.lower()]
+        versions[resourceType.resource_type.lower()] = (stable or apiVersions)[0]
+    return versions
+
+
+def resolveApiVersion(resourceClient: ResourceManagementClient, resourceUri: str) -> str:
+    """ Return the API version to GET a resource with. The provider is read once per worker. """
+    namespace, resourceType = parseResourceType(resourceUri)
+
+    with _lock:
+        versions = _providers.get(namespace)
+        namespaceLock = _namespaceLocks.setdefault(namespace, threading.Lock()) if versions is None else None
+
+    if versions is None:
+        with namespaceLock:
+            # Another caller may have read the provider while this one waited
+            with _lock:
+                versions = _providers.get(namespace)
+            if versions is None:
+                try:
+                    with span("apiVersionLookup"):
+                        versions = _versionsOf(resourceClient.providers.get(namespace))
+                except Exception as e:
+                    # Not cached, so the provider is read again on the next call
+                    logging.info("API versions could not be read for " + namespace + " : " + str(e))
+                    return DEFAULT_API_VERSION
+                with _lock:
+                    _providers[namespace] = versions
+
+    return versions.get(resourceType, DEFAULT_API_VERSION)
+
+
+async def resolveApiVersionAsync(resourceClient, resourceUri: str) -> str:
+    """ resolveApiVersion for an aio ResourceManagementClient. Both share the same cache. """
+    namespace, resourceType = parseResourceType(resourceUri)
+
+    with _lock:
+        versions = _providers.get(namespace)
+        if versions is None:
+            loopLocks = _asyncNamespaceLocks.setdefault(asyncio.get_running_loop(), {})
+            namespaceLock = loopLocks.setdefault(namespace, asyncio.Lock())
+
+    if versions is None:
+        async with namespaceLock:
+            with _lock:
+                versions = _providers.get(namespace)
+            if versions is None:
+                try:
+                    with span("apiVersionLookup"):
+                        versions = _versionsOf(await resourceClient.providers.get(namespace))
+                except Exception as e:
+                    logging.info("API versions could not be read for " + namespace + " : " + str(e))
+                    return DEFAULT_API_VERSION
+                with _lock:
+                    _providers[namespace] = versions
+
+    return versions.get(resourceType, DEFAULT_API_VERSION)
+
+
+def invalidate():
+    """ Drop every cached provider. The next lookup reads the provider again. """
+    with _lock:
+        _providers.clear()
@@ -0,0 +1,78 @@
+import os
+import time
+import threading
+from collections import OrderedDict
+
+# Marker returned by TtlLruCache.get when a key is not cached
+MISSING = object()
+
+
+class TtlLruCache:
+    """ Bounded LRU cache where every entry expires after a TTL.
+
+        Storing None caches a negative result (e.g. an AppId that is not in CosmosDB). Negative
+        entries use their own, usually shorter, TTL so new AppIds are picked up quickly. """
+
+    def __init__(self, maxSize: int, ttl: float, negativeTtl: float):
+        self.maxSize = max(1, maxSize)
+        self.ttl = ttl
+        self.negativeTtl = negativeTtl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._stats = {"hits": 0, "negativeHits": 0, "misses": 0, "evictions": 0, "expirations": 0, "invalidations": 0}
+
+    def get(self, key):
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self._stats["misses"] += 1
+                return MISSING
+
+            value, expires = entry
+            if expires <= time.monotonic():
+                del self._entries[key]
+                self._stats["expirations"] += 1
+                self._stats["misses"] += 1
+                return MISSING
+
+            # Mark as most recently used
+            self._entries.move_to_end(key)
+            self._stats["hits" if value is not None else "negativeHits"] += 1
+            return value
+
+    def put(self, key, value):
+        ttl = self.ttl if value is not None else self.negativeTtl
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + ttl)
+            self._entries.move_to_end(key)
+            # Evict least recently used entries once the cache is full
+            while len(self._entries) > self.maxSize:
+                self._entries.popitem(last=False)
+                self._stats["evictions"] += 1
+
+    def invalidate(self, keys: list = None):
+        # Drop the given keys, or everything when no keys are given
+        with self._lock:
+            if keys is None:
+                self._stats["invalidations"] += len(self._entries)
+                self._entries.clear()
+                return
+            for key in keys:
+                if self._entries.pop(key, None) is not None:
+                    self._stats["invalidations"] += 1
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["size"] = len(self._entries)
+            return stats
+
+
+# Worker wide cache of AppId -> CosmosDB document. Shared by every function in the app, so
+# CSVUploadTrigger can invalidate rows it upserts on this worker. Other workers pick the new
+# rows up when their entries expire.
+appIdCache = TtlLruCache(
+    int(os.environ.get("APPID_CACHE_SIZE", "1024")),
+    float(os.environ.get("APPID_CACHE_TTL", "300")),
+    float(os.environ.get("APPID_CACHE_NEGATIVE_TTL", "60"))
+)
@@ -0,0 +1,201 @@
+import json
+import logging
+import threading
+from shared_code.appid_cache import appIdCache, MISSING
+from shared_code.appid_snapshot import appIdSnapshot
+from shared_code.metrics import span, cosmosResponseHook
+
+# Worker wide cache of container link -> partition key path. When the AppId container is
+# partitioned on /id the AppId is also the partition key and lookups can be point reads, any
+# other path uses queries, which work with every partition key.
+_partitionKeyPaths = {}
+_lock = threading.Lock()
+
+# Number of AppIds resolved per batched query
+BATCH_SIZE = 100
+
+
+def partitionKeyPath(container) -> str:
+    """ Return the partition key path of a container, e.g. /id, or None when it cannot be read.
+        The container properties are read once per worker. """
+    path = _partitionKeyPaths.get(container.container_link)
+    if path is not None:
+        return path
+    with _lock:
+        path = _partitionKeyPaths.get(container.container_link)
+        if path is None:
+            try:
+                with span("cosmosContainerRead"):
+                    path = container.read()['partitionKey']['paths'][0]
+            except Exception as e:
+                # Not cached, so the next lookup tries again. Queries work in the meantime.
+                logging.info("Partition key of " + container.container_link + " could not be read: " + str(e))
+                return None
+            _partitionKeyPaths[container.container_link] = path
+    return path
+
+
+async def partitionKeyPathAsync(container) -> str:
+    """ partitionKeyPath for an azure.cosmos.aio container. Both share the same cache. """
+    path = _partitionKeyPaths.get(container.container_link)
+    if path is None:
+        try:
+            with span("cosmosContainerRead"):
+                path = (await container.read())['partitionKey']['paths'][0]
+        except Exception as e:
+            logging.info("Partition key of " + container.container_link + " could not be read: " + str(e))
+            return None
+        _partitionKeyPaths[container.container_link] = path
+    return path
+
+
+def partitionKeyExpression(path: str) -> str:
+    # Query expression of a partition key path, e.g. c["owner"] for a path of /owner
+    return "c" + "".join("[" + json.dumps(part) + "]" for part in path.strip("/").split("/"))
+
+
+def lookupAppId(container, appId: str) -> dict:
+    """ Return the CosmosDB document for an AppId, or None if the AppId is unknown. """
+    # The published snapshot answers most lookups without a CosmosDB round-trip
+    document = appIdSnapshot.get(appId)
+    if document is MISSING:
+        document = appIdCache.get(appId)
+    if document is not MISSING:
+        return document
+
+    if partitionKeyPath(container) == "/id":
+        # Imported on first use, azure.cosmos is loaded by then anyway
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        # Point read: the cheapest way to read a single document
+        try:
+            with span("cosmosLookup"):
+                document = dict(container.read_item(item=appId, partition_key=appId, response_hook=cosmosResponseHook))
+        except CosmosResourceNotFoundError:
+            document = None
+    else:
+        document = None
+        with span("cosmosLookup"):
+            for item in container.query_items(
+                query="SELECT * FROM c WHERE c.id = @id",
+                parameters=[{"name": "@id", "value": appId}],
+                enable_cross_partition_query=True,
+                response_hook=cosmosResponseHook,
+            ):
+                document = dict(item)
+
+    appIdCache.put(appId, document)
+    return document
+
+
+def lookupAppIds(container, appIds: list) -> dict:
+    """ Resolve many AppIds with as few round-trips as possible.
+
+        Returns a dictionary of AppId to document, with None for unknown AppIds. """
+    documents = {}
+    missing = []
+    for appId in dict.fromkeys(appIds):
+        document = appIdSnapshot.get(appId)
+        if document is MISSING:
+            document = appIdCache.get(appId)
+        if document is MISSING:
+            missing.append(appId)
+        else:
+            documents[appId] = document
+
+    for start in range(0, len(missing), BATCH_SIZE):
+        batch = missing[start:start + BATCH_SIZE]
+        with span("cosmosBatchLookup"):
+            found = {item['id']: dict(item) for item in _readBatch(container, batch)}
+        for appId in batch:
+            documents[appId] = found.get(appId)
+            appIdCache.put(appId, documents[appId])
+
+    return documents
+
+
+def _readBatch(container, appIds: list):
+    if partitionKeyPath(container) == "/id" and hasattr(container, "read_items"):
+        # Batched point reads, available in newer versions of azure-cosmos
+        return container.read_items(items=[(appId, appId) for appId in appIds], response_hook=cosmosResponseHook)
+
+    # Single parameterized IN query for the whole batch
+    names = ["@id" + str(index) for index in range(len(appIds))]
+    return container.query_items(
+        query="SELECT * FROM c WHERE c.id IN (" + ", ".join(names) + ")",
+        parameters=[{"name": name, "value": appId} for name, appId in zip(names, appIds)],
+        enable_cross_partition_query=True,
+        response_hook=cosmosResponseHook,
+    )
+
+
+async def lookupAppIdAsync(container, appId: str) -> dict:
+    """ lookupAppId for an azure.cosmos.aio container. Both share the same cache. """
+    # The published snapshot answers most lookups without a CosmosDB round-trip
+    document = appIdSnapshot.get(appId)
+    if document is MISSING:
+        document = appIdCache.get(appId)
+    if document is not MISSING:
+        return document
+
+    if await partitionKeyPathAsync(container) == "/id":
+        from azure.cosmos.exceptions import CosmosResourceNotFoundError
+        try:
+            with span("cosmosLookup"):
+                document = dict(await container.read_item(item=appId, partition_key=appId, response_hook=cosmosResponseHook))
+        except CosmosResourceNotFoundError:
+            document = None
+    else:
+        document = None
+        # Cross partition queries are the default for aio containers
+        with span("cosmosLookup"):
+            async for item in container.query_items(
+                query="SELECT * FROM c WHERE c.id = @id",
+                parameters=[{"name": "@id", "value": appId}],
+                response_hook=cosmosResponseHook,
+            ):
+                document = dict(item)
+
+    appIdCache.put(appId, document)
+    return document
+
+
+async def lookupAppIdsAsync(container, appIds: list) -> dict:
+    """ lookupAppIds for an azure.cosmos.aio container. """
+    documents = {}
+    missing = []
+    for appId in dict.fromkeys(appIds):
+        document = appIdSnapshot.get(appId)
+        if document is MISSING:
+            document = appIdCache.get(appId)
+        if document is MISSING:
+            missing.append(appId)
+        else:
+            documents[appId] = document
+
+    for start in range(0, len(missing), BATCH_SIZE):
+        batch = missing[start:start + BATCH_SIZE]
+        with span("cosmosBatchLookup"):
+            found = {item['id']: dict(item) for item in await _readBatchAsync(container, batch)}
+        for appId in batch:
+            documents[appId] = found.get(appId)
+            appIdCache.put(appId, documents[appId])
+
+    return documents
+
+
+async def _readBatchAsync(container, appIds: list) -> list:
+    if await partitionKeyPathAsync(container) == "/id" and hasattr(container, "read_items"):
+        return await container.read_items(items=[(appId, appId) for appId in appIds], response_hook=cosmosResponseHook)
+
+    names = ["@id" + str(index) for index in range(len(appIds))]
+    return [item async for item in container.query_items(
+        query="SELECT * FROM c WHERE c.id IN (" + ", ".join(names) + ")",
+        parameters=[{"name": name, "value": appId} for name, appId in zip(names, appIds)],
+        response_hook=cosmosResponseHook,
+    )]
+
+
+def invalidate():
+    """ Forget every cached partition key path. The next lookup reads the container again. """
+    with _lock:
+        _partitionKeyPaths.clear()
@@ -0,0 +1,161 @@
+import os
+import gzip
+import json
+import time
+import hashlib
+import logging
+import threading
+from azure.core.exceptions import ResourceNotFoundError, ResourceExistsError
+from datetime import datetime, timezone
+from shared_code.appid_cache import MISSING
+from shared_code.metrics import span, cosmosResponseHook
+
+# Version of the snapshot file layout. Workers ignore snapshots in a layout they do not know.
+FORMAT = 1
+
+
+def snapshotSettings() -> tuple:
+    # Blob container and name of the snapshot. An empty container turns the snapshot off.
+    return os.environ.get("APPID_SNAPSHOT_CONTAINER", "appid-snapshot"), os.environ.get("APPID_SNAPSHOT_BLOB", "appids.json.gz")
+
+
+def buildSnapshot(container) -> tuple:
+    """ Read every AppId from CosmosDB and return the gzipped snapshot and its version.
+
+        The version is a hash of the content, so uploading an unchanged table gives the same
+        version and workers do not reload it. """
+    appIds = {}
+    for item in container.query_items(
+        query="SELECT c.id, c.appName, c.owner FROM c",
+        enable_cross_partition_query=True,
+        response_hook=cosmosResponseHook,
+    ):
+        appIds[item['id']] = [item.get('appName'), item.get('owner')]
+
+    content = json.dumps(appIds, sort_keys=True, separators=(",", ":"))
+    version = hashlib.sha256(content.encode("utf-8")).hexdigest()
+    snapshot = {
+        "format": FORMAT,
+        "version": version,
+        "generatedAt": datetime.now(timezone.utc).isoformat(),
+        "count": len(appIds),
+        "appIds": appIds,
+    }
+    return gzip.compress(json.dumps(snapshot, separators=(",", ":")).encode("utf-8")), version
+
+
+def publishSnapshot(containerClient, blobName: str, container) -> dict:
+    """ Upload a new snapshot when the AppId table changed since the last one. The blob
+        container is created on the first upload to a new storage account. """
+    with span("snapshotBuild"):
+        data, version = buildSnapshot(container)
+
+    try:
+        containerClient.create_container()
+    except ResourceExistsError:
+        pass
+
+    blobClient = containerClient.get_blob_client(blobName)
+    try:
+        properties = blobClient.get_blob_properties()
+        published, etag = properties.metadata.get("version"), properties.etag
+    except Exception:
+        # No snapshot yet, or it cannot be read, either way a new one is uploaded
+        published, etag = None, None
+
+    if published != version:
+        with span("snapshotUpload"):
+            etag = blobClient.upload_blob(data, overwrite=True, metadata={"version": version, "format": str(FORMAT)}).get("etag")
+        logging.info("Published AppId snapshot " + version + " (" + str(len(data)) + " bytes)")
+
+    # This worker uses the new table right away, other workers pick it up when they poll
+    appIdSnapshot.load(data, etag)
+    return {"version": version, "published": published != version, "bytes": len(data)}
+
+
+class AppIdSnapshot:
+    """ In memory copy of the AppId table published by CSVUploadTrigger.
+
+        Lookups are dictionary reads, so tagging does not wait for CosmosDB. The blob is polled
+        at most once per poll interval and only downloaded when its ETag changed. AppIds that
+        are not in the snapshot fall back to CosmosDB. """
+
+    def __init__(self, pollInterval: float):
+        self.pollInterval = pollInterval
+        self.version = None
+        self._appIds = None
+        self._etag = None
+        self._nextPoll = 0.0
+        self._refreshLock = threading.Lock()
+        self._stats = {"loads": 0, "polls": 0, "errors": 0}
+
+    def get(self, appId: str):
+        # Return the document for an AppId, or MISSING when it has to be read from CosmosDB
+        appIds = self._appIds
+        entry = appIds.get(appId) if appIds is not None else None
+        if entry is None:
+            return MISSING
+        return {"id": appId, "appName": entry[0], "owner": entry[1]}
+
+    def load(self, data: bytes, etag: str = None) -> bool:
+        snapshot = json.loads(gzip.decompress(data))
+        if snapshot.get("format") != FORMAT:
+            logging.info("Ignoring AppId snapshot in unknown format: " + str(snapshot.get("format")))
+            return False
+        # Entries are stored as tuples, which are smaller than lists
+        appIds = {appId: tuple(entry) for appId, entry in snapshot["appIds"].items()}
+        # Swapping the reference is atomic, readers see either the old or the new table
+        self._appIds = appIds
+        self.version = snapshot["version"]
+        self._etag = etag
+        self._stats["loads"] += 1
+        return True
+
+    def refresh(self, registry):
+        """ Poll the snapshot blob when the poll interval has passed.
+
+            registry is the worker's client registry. Its blob client is only built when a poll
+            is due, so functions work without BLOB_CONNECTION_STRING while the snapshot is off.
+            Only one thread polls at a time, the others keep using the table they have. """
+        containerName, blobName = snapshotSettings()
+        if not containerName or time.monotonic() < self._nextPoll:
+            return
+        if not self._refreshLock.acquire(blocking=False):
+            return
+        try:
+            if time.monotonic() < self._nextPoll:
+                return
+            self._stats["polls"] += 1
+            blobClient = registry.blob_service_client.get_container_client(containerName).get_blob_client(blobName)
+            with span("snapshotPoll"):
+                etag = blobClient.get_blob_properties().etag
+                if etag != self._etag:
+                    self.load(blobClient.download_blob().readall(), etag)
+                    logging.info("Loaded AppId snapshot " + str(self.version) + " with " + str(len(self._appIds)) + " AppIds")
+        except ResourceNotFoundError:
+            # Nothing published yet, lookups use CosmosDB until the first CSV upload
+            pass
+        except Exception as e:
+            # Lookups fall back to CosmosDB until the snapshot can be read
+            self._stats["errors"] += 1
+            logging.info("AppId snapshot could not be refreshed: " + str(e))
+        finally:
+            self._nextPoll = time.monotonic() + self.pollInterval
+            self._refreshLock.release()
+
+    def clear(self):
+        # Forget the loaded table, the next refresh downloads it again
+        self._appIds = None
+        self.version = None
+        self._etag = None
+        self._nextPoll = 0.0
+
+    def stats(self) -> dict:
+        stats = dict(self._stats)
+        stats["size"] = len(self._appIds) if self._appIds is not None else 0
+        stats["version"] = self.version
+        return stats
+
+
+# Worker wide, shared by every function in the app like appIdCache
+appIdSnapshot = AppIdSnapshot(float(os.environ.get("APPID_SNAPSHOT_POLL_INTERVAL", "60")))
@@ -0,0 +1,109 @@
+import os
+import base64
+import logging
+import threading
+from urllib.parse import urlparse
+from shared_code.appid_cache import TtlLruCache, MISSING
+from shared_code.metrics import span
+
+
+class KeyWrapper:
+    """ Key encryption key in the interface used by the storage SDK's client-side encryption.
+
+        The key is a 256 bit AES key kept as a Key Vault secret, so wrapping and unwrapping run
+        locally and Key Vault is only asked for the secret. Unwrapped content keys are cached,
+        so re-reading a blob, or several blobs written with the same content key, skips the
+        unwrap as well. """
+
+    def __init__(self, kid: str, keyBytes: bytes, contentKeys: TtlLruCache):
+        # Imported here so functions that never read encrypted blobs do not load the Key Vault SDK
+        from azure.keyvault.keys import JsonWebKey, KeyType
+        from azure.keyvault.keys.crypto import CryptographyClient, KeyWrapAlgorithm
+        self.kid = kid
+        self.algorithm = KeyWrapAlgorithm.aes_256
+        self._contentKeys = contentKeys
+        self.client = CryptographyClient.from_jwk(JsonWebKey(kid=kid, kty=KeyType.oct, key_ops=['wrapKey', 'unwrapKey'], k=keyBytes))
+
+    def wrap_key(self, key):
+        wrapped = self.client.wrap_key(self.algorithm, key)
+        return wrapped.encrypted_key
+
+    def unwrap_key(self, key, algorithm):
+        if algorithm != self.algorithm:
+            raise ValueError('Unknown key wrap algorithm. {}'.format(algorithm))
+        cacheKey = (self.kid, bytes(key))
+        contentKey = self._contentKeys.get(cacheKey)
+        if contentKey is MISSING:
+            with span("keyUnwrap"):
+                contentKey = self.client.unwrap_key(self.algorithm, key).key
+            self._contentKeys.put(cacheKey, contentKey)
+        return contentKey
+
+    def get_key_wrap_algorithm(self):
+        return self.algorithm
+
+    def get_kid(self):
+        return self.kid
+
+
+class KeyResolver:
+    """ Resolves the key id recorded on an encrypted blob to a cached KeyWrapper.
+
+        The key id is the id of the Key Vault secret holding the key encryption key, including
+        its version, so blobs written before a key rotation still resolve to the key they were
+        written with. Only versions of the configured secret in the configured vault are read. """
+
+    def __init__(self, secretName: str, keyTtl: float, contentKeyCacheSize: int, contentKeyTtl: float):
+        self.secretName = secretName
+        self._keys = TtlLruCache(16, keyTtl, 0)
+        self._contentKeys = TtlLruCache(contentKeyCacheSize, contentKeyTtl, 0)
+        self._lock = threading.Lock()
+
+    def bind(self, secretClient):
+        """ Return a key_resolver_function for blob clients that reads keys with secretClient. """
+        return lambda kid: self.resolve(secretClient, kid)
+
+    def resolve(self, secretClient, kid: str) -> KeyWrapper:
+        wrapper = self._keys.get(kid)
+        if wrapper is not MISSING:
+            return wrapper
+
+        # One Key Vault round-trip per key and TTL, concurrent uploads wait for the first
+        with self._lock:
+            wrapper = self._keys.get(kid)
+            if wrapper is MISSING:
+                vaultUrl, name, version = _parseSecretId(kid)
+                if vaultUrl != secretClient.vault_url.rstrip("/").lower() or name != self.secretName:
+                    raise ValueError("Blob was encrypted with a key that is not the configured key encryption key: " + kid)
+                with span("keyFetch"):
+                    secret = secretClient.get_secret(name, version)
+                wrapper = KeyWrapper(kid, base64.urlsafe_b64decode(secret.value), self._contentKeys)
+                self._keys.put(kid, wrapper)
+                logging.info("Loaded key encryption key " + kid)
+        return wrapper
+
+    def invalidate(self):
+        # Forget every key, e.g. after the key encryption key was revoked
+        self._keys.invalidate()
+        self._contentKeys.invalidate()
+
+    def stats(self) -> dict:
+        return {"keys": self._keys.stats(), "contentKeys": self._contentKeys.stats()}
+
+
+def _parseSecretId(kid: str) -> tuple:
+    # https://{vault}.vault.azure.net/secrets/{name}/{version}
+    parsed = urlparse(kid)
+    parts = [part for part in parsed.path.split("/") if part]
+    if len(parts) != 3 or parts[0] != "secrets":
+        raise ValueError("Key id is not a versioned Key Vault secret id: " + kid)
+    return (parsed.scheme + "://" + parsed.netloc).lower(), parts[1], parts[2]
+
+
+# Worker wide, so one Key Vault round-trip serves every upload the worker handles within the TTL
+keyResolver = KeyResolver(
+    os.environ.get("CMK_SECRET_NAME", "auto-tag-func-cmk"),
+    float(os.environ.get("KEK_CACHE_TTL", "3600")),
+    int(os.environ.get("CEK_CACHE_SIZE", "256")),
+    float(os.environ.get("CEK_CACHE_TTL", "3600"))
+)
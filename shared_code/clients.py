@@ -0,0 +1,227 @@
+from __future__ import annotations
+import os
+import logging
+import threading
+from typing import TYPE_CHECKING
+from shared_code.throttle import ArmThrottle, ThrottleHeadersPolicy
+from shared_code.event_queue import StorageEventQueue, QUEUE_NAME
+
+# Each SDK is imported by the property that builds its client, so a function only loads the
+# SDKs it actually uses. Importing all of them up front dominated cold start.
+if TYPE_CHECKING:
+    from azure.identity import ClientSecretCredential
+    from azure.mgmt.resource import ResourceManagementClient
+    from azure.mgmt.monitor import MonitorManagementClient
+    from azure.cosmos import CosmosClient
+    from azure.storage.blob import BlobServiceClient
+    from azure.keyvault.secrets import SecretClient
+
+# App settings the SDK clients are built from. If any of these change the registry is rebuilt.
+SETTINGS = (
+    "CLIENT_ID",
+    "CLIENT_SECRET",
+    "TENANT_ID",
+    "AUTHORITY",
+    "SUBSCRIPTION_ID",
+    "COSMOS_URL",
+    "COSMOS_KEY",
+    "COSMOS_DATABASE_NAME",
+    "COSMOS_CONTAINER_NAME",
+    "BLOB_CONNECTION_STRING",
+    "DEPLOYMENT_CONCURRENCY",
+    "ARM_RATELIMIT_LOW_WATERMARK",
+    "AzureWebJobsStorage",
+    "DEDUP_COSMOS_CONTAINER_NAME",
+    "KEY_VAULT_URI",
+)
+
+# Module level state. Azure Functions keeps the module loaded between invocations on a worker,
+# so anything stored here is reused by every request the worker handles.
+_lock = threading.Lock()
+_registry = None
+_installed = False
+_stats = {"cold": 0, "warm": 0, "rebuilds": 0}
+
+
+class ClientRegistry:
+    """ Lazily built set of SDK clients sharing one credential.
+
+        The credential keeps its own token cache and every management client keeps its own
+        HTTP connection pool, so holding on to the instances avoids a token fetch and a TLS
+        handshake per invocation. """
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self._lock = threading.Lock()
+        self._credential = None
+        self._resource_client = None
+        self._monitor_client = None
+        self._cosmos_client = None
+        self._container = None
+        self._blob_service_client = None
+        self._event_queue = None
+        self._dedup_container = None
+        self._secret_client = None
+
+        # ARM rate limits apply per subscription, so every caller on this worker shares one throttle
+        self.throttle = ArmThrottle(
+            int(settings["DEPLOYMENT_CONCURRENCY"] or "16"),
+            int(settings["ARM_RATELIMIT_LOW_WATERMARK"] or "100")
+        )
+
+    @property
+    def credential(self) -> ClientSecretCredential:
+        with self._lock:
+            if self._credential is None:
+                from azure.identity import ClientSecretCredential
+                self._credential = ClientSecretCredential(
+                    self.settings["TENANT_ID"],
+                    self.settings["CLIENT_ID"],
+                    self.settings["CLIENT_SECRET"],
+                    authority=self.settings["AUTHORITY"]
+                )
+            return self._credential
+
+    @property
+    def resource_client(self) -> ResourceManagementClient:
+        credential = self.credential
+        with self._lock:
+            if self._resource_client is None:
+                from azure.mgmt.resource import ResourceManagementClient
+                # Instantiate Resource Management Client to query and update tags
+                self._resource_client = ResourceManagementClient(
+                    credential=credential,
+                    subscription_id=self.settings["SUBSCRIPTION_ID"],
+                    api_version="2020-10-01",
+                    per_retry_policies=[ThrottleHeadersPolicy(self.throttle)]
+                )
+            return self._resource_client
+
+    @property
+    def monitor_client(self) -> MonitorManagementClient:
+        credential = self.credential
+        with self._lock:
+            if self._monitor_client is None:
+                from azure.mgmt.monitor import MonitorManagementClient
+                self._monitor_client = MonitorManagementClient(credential, self.settings["SUBSCRIPTION_ID"])
+            return self._monitor_client
+
+    @property
+    def cosmos_client(self) -> CosmosClient:
+        with self._lock:
+            if self._cosmos_client is None:
+                from azure.cosmos import CosmosClient
+                # Instantiate CosmosDB Client using the url and access key
+                self._cosmos_client = CosmosClient(self.settings["COSMOS_URL"], self.settings["COSMOS_KEY"])
+            return self._cosmos_client
+
+    @property
+    def container(self):
+        cosmos_client = self.cosmos_client
+        with self._lock:
+            if self._container is None:
+                # Intantiate CosmosDB Database and Container Clients using CosmosDB Client
+                database = cosmos_client.get_database_client(self.settings["COSMOS_DATABASE_NAME"])
+                self._container = database.get_container_client(self.settings["COSMOS_CONTAINER_NAME"])
+            return self._container
+
+    @property
+    def dedup_container(self):
+        # Optional container shared by all workers to dedupe events, None when not configured
+        if not self.settings["DEDUP_COSMOS_CONTAINER_NAME"]:
+            return None
+        cosmos_client = self.cosmos_client
+        with self._lock:
+            if self._dedup_container is None:
+                database = cosmos_client.get_database_client(self.settings["COSMOS_DATABASE_NAME"])
+                self._dedup_container = database.get_container_client(self.settings["DEDUP_COSMOS_CONTAINER_NAME"])
+            return self._dedup_container
+
+    @property
+    def blob_service_client(self) -> BlobServiceClient:
+        credential = self.credential
+        with self._lock:
+            if self._blob_service_client is None:
+                from azure.storage.blob import BlobServiceClient
+                # Instatinate Blob Storage client using connection string
+                self._blob_service_client = BlobServiceClient.from_connection_string(self.settings["BLOB_CONNECTION_STRING"], credential=credential)
+            return self._blob_service_client
+
+    @property
+    def secret_client(self) -> SecretClient:
+        # Key Vault holding the key encryption key of encrypted uploads, None when not configured
+        if not self.settings["KEY_VAULT_URI"]:
+            return None
+        credential = self.credential
+        with self._lock:
+            if self._secret_client is None:
+                from azure.keyvault.secrets import SecretClient
+                self._secret_client = SecretClient(self.settings["KEY_VAULT_URI"], credential=credential)
+            return self._secret_client
+
+    @property
+    def event_queue(self) -> StorageEventQueue:
+        with self._lock:
+            if self._event_queue is None:
+                # Same storage account and queue the AutoTagQueueTrigger binding listens on
+                self._event_queue = StorageEventQueue(self.settings["AzureWebJobsStorage"], QUEUE_NAME)
+            return self._event_queue
+
+    def close(self):
+        # Release connection pools held by the clients. Errors are ignored because the
+        # registry is being discarded anyway.
+        for client in (self._resource_client, self._monitor_client, self._blob_service_client, self._event_queue, self._secret_client, self._credential):
+            try:
+                if client is not None:
+                    client.close()
+            except Exception as e:
+                logging.info("Error closing client: " + str(e))
+
+
+def _currentSettings() -> dict:
+    return {name: os.environ.get(name, None) for name in SETTINGS}
+
+
+def getClients() -> ClientRegistry:
+    """ Return the worker's client registry, building it on first use or when app settings change. """
+    global _registry
+
+    settings = _currentSettings()
+    with _lock:
+        if _installed or (_registry is not None and _registry.settings == settings):
+            _stats["warm"] += 1
+            return _registry
+
+        if _registry is not None:
+            _stats["rebuilds"] += 1
+            logging.info("App settings changed, rebuilding SDK clients")
+            _registry.close()
+
+        _stats["cold"] += 1
+        _registry = ClientRegistry(settings)
+        return _registry
+
+
+def install(registry):
+    """ Make getClients return the given registry, e.g. one holding fake clients for the
+        benchmarks, regardless of app settings until reset is called. """
+    global _registry, _installed
+    with _lock:
+        _registry = registry
+        _installed = True
+
+
+def reset():
+    """ Drop the cached registry. The next call to getClients builds a new one. """
+    global _registry, _installed
+    with _lock:
+        if _registry is not None:
+            _registry.close()
+        _registry = None
+        _installed = False
+
+
+def stats() -> dict:
+    """ Counters for cold (registry built) and warm (registry reused) lookups. """
+    with _lock:
+        return dict(_stats)
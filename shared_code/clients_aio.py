@@ -0,0 +1,152 @@
+import asyncio
+import logging
+import threading
+import aiohttp
+from azure.core.pipeline.transport import AioHttpTransport
+from azure.identity.aio import ClientSecretCredential
+from azure.mgmt.resource.resources.aio import ResourceManagementClient
+from azure.mgmt.monitor.aio import MonitorManagementClient
+from azure.cosmos.aio import CosmosClient
+from shared_code.clients import _currentSettings
+from shared_code.throttle import ArmThrottle, ThrottleHeadersPolicy
+
+# Module level state, see shared_code.clients. The aiohttp session belongs to the event loop it
+# was created on, so the registry is also rebuilt when the worker's loop changes.
+_lock = threading.Lock()
+_registry = None
+_installed = False
+_stats = {"cold": 0, "warm": 0, "rebuilds": 0}
+
+
+class AsyncClientRegistry:
+    """ Lazily built set of aio SDK clients sharing one credential and one aiohttp session.
+
+        Every client sends its requests through the same session, so connections are pooled
+        across ARM, Monitor and CosmosDB instead of each client opening its own. """
+
+    def __init__(self, settings: dict, loop: asyncio.AbstractEventLoop):
+        self.settings = settings
+        self.loop = loop
+        self._session = None
+        self._credential = None
+        self._resource_client = None
+        self._monitor_client = None
+        self._cosmos_client = None
+        self._container = None
+
+        # ARM rate limits apply per subscription, so every caller on this worker shares one throttle
+        self.throttle = ArmThrottle(
+            int(settings["DEPLOYMENT_CONCURRENCY"] or "16"),
+            int(settings["ARM_RATELIMIT_LOW_WATERMARK"] or "100")
+        )
+
+    # Properties are only used from the registry's event loop, so they need no lock
+
+    def _transport(self) -> AioHttpTransport:
+        if self._session is None:
+            self._session = aiohttp.ClientSession()
+        return AioHttpTransport(session=self._session, session_owner=False)
+
+    @property
+    def credential(self) -> ClientSecretCredential:
+        if self._credential is None:
+            self._credential = ClientSecretCredential(
+                self.settings["TENANT_ID"],
+                self.settings["CLIENT_ID"],
+                self.settings["CLIENT_SECRET"],
+                authority=self.settings["AUTHORITY"],
+                transport=self._transport()
+            )
+        return self._credential
+
+    @property
+    def resource_client(self) -> ResourceManagementClient:
+        if self._resource_client is None:
+            self._resource_client = ResourceManagementClient(
+                credential=self.credential,
+                subscription_id=self.settings["SUBSCRIPTION_ID"],
+                api_version="2020-10-01",
+                per_retry_policies=[ThrottleHeadersPolicy(self.throttle)],
+                transport=self._transport()
+            )
+        return self._resource_client
+
+    @property
+    def monitor_client(self) -> MonitorManagementClient:
+        if self._monitor_client is None:
+            self._monitor_client = MonitorManagementClient(self.credential, self.settings["SUBSCRIPTION_ID"], transport=self._transport())
+        return self._monitor_client
+
+    @property
+    def cosmos_client(self) -> CosmosClient:
+        if self._cosmos_client is None:
+            self._cosmos_client = CosmosClient(self.settings["COSMOS_URL"], self.settings["COSMOS_KEY"], transport=self._transport())
+        return self._cosmos_client
+
+    @property
+    def container(self):
+        if self._container is None:
+            database = self.cosmos_client.get_database_client(self.settings["COSMOS_DATABASE_NAME"])
+            self._container = database.get_container_client(self.settings["COSMOS_CONTAINER_NAME"])
+        return self._container
+
+    async def close(self):
+        # Clients first, then the session they share. Errors are ignored because the
+        # registry is being discarded anyway.
+        for client in (self._resource_client, self._monitor_client, self._cosmos_client, self._credential, self._session):
+            try:
+                if client is not None:
+                    await client.close()
+            except Exception as e:
+                logging.info("Error closing client: " + str(e))
+
+
+async def getClients() -> AsyncClientRegistry:
+    """ Return the worker's aio client registry, building it on first use, when app settings
+        change or when called from a different event loop. """
+    global _registry
+
+    settings = _currentSettings()
+    loop = asyncio.get_running_loop()
+    stale = None
+    with _lock:
+        if _installed or (_registry is not None and _registry.settings == settings and _registry.loop is loop):
+            _stats["warm"] += 1
+            return _registry
+
+        if _registry is not None:
+            _stats["rebuilds"] += 1
+            logging.info("App settings or event loop changed, rebuilding aio SDK clients")
+            stale = _registry
+
+        _stats["cold"] += 1
+        _registry = AsyncClientRegistry(settings, loop)
+        registry = _registry
+
+    # A registry from another loop cannot be closed from this one, its loop is gone
+    if stale is not None and stale.loop is loop:
+        await stale.close()
+    return registry
+
+
+def install(registry):
+    """ Make getClients return the given registry, e.g. one holding fake clients for the
+        benchmarks, regardless of app settings and event loop until reset is called. """
+    global _registry, _installed
+    with _lock:
+        _registry = registry
+        _installed = True
+
+
+def reset():
+    """ Forget the cached registry. It is not closed, its event loop may already be gone. """
+    global _registry, _installed
+    with _lock:
+        _registry = None
+        _installed = False
+
+
+def stats() -> dict:
+    """ Counters for cold (registry built) and warm (registry reused) lookups. """
+    with _lock:
+        return dict(_stats)
@@ -0,0 +1,104 @@
+import os
+import logging
+import hashlib
+import threading
+from shared_code.appid_cache import TtlLruCache, MISSING
+
+
+class EventDeduper:
+    """ Remembers recently handled EventGrid events so redeliveries and overlapping events are
+        answered without touching ARM or CosmosDB.
+
+        An event is a duplicate when its id, its (resourceUri, operationName) pair or its resource
+        was seen within the TTL. The resource key is set by remember, e.g. once a group deployment
+        has tagged one of its output resources, which covers that resource's own write event.
+
+        Keys are kept in memory per worker. When a shared CosmosDB container is passed to claim,
+        the (resourceUri, operationName) key is also claimed there with an atomic create, so other
+        workers see it too. Documents carry a ttl, so the container needs a default TTL enabled. """
+
+    def __init__(self, maxSize: int, ttl: float):
+        self.ttl = ttl
+        self._seen = TtlLruCache(maxSize, ttl, ttl)
+        self._lock = threading.Lock()
+        self._stats = {"eventId": 0, "resourceOperation": 0, "resource": 0, "shared": 0, "misses": 0, "released": 0}
+
+    @staticmethod
+    def _keys(body: dict) -> dict:
+        data = body.get('data', {})
+        resourceUri = data.get('resourceUri', '').lower()
+        return {
+            "eventId": "event:" + str(body.get('id')) if body.get('id') else None,
+            "resourceOperation": "operation:" + resourceUri + "|" + data.get('operationName', '').lower() if resourceUri else None,
+            "resource": "resource:" + resourceUri if resourceUri else None,
+        }
+
+    def claim(self, body: dict, sharedContainer: any = None) -> str:
+        """ Record the event and return None, or return the reason it is a duplicate. """
+        keys = self._keys(body)
+        with self._lock:
+            for kind, key in keys.items():
+                if key and self._seen.get(key) is not MISSING:
+                    self._stats[kind] += 1
+                    return kind
+            for kind in ("eventId", "resourceOperation"):
+                if keys[kind]:
+                    self._seen.put(keys[kind], True)
+
+        if sharedContainer is not None and keys["resourceOperation"]:
+            # Imported on first use, functions without a shared store never load azure.cosmos
+            from azure.cosmos.exceptions import CosmosResourceExistsError
+            try:
+                sharedContainer.create_item({"id": _documentId(keys["resourceOperation"]), "ttl": int(self.ttl)})
+            except CosmosResourceExistsError:
+                with self._lock:
+                    self._stats["shared"] += 1
+                return "shared"
+            except Exception as e:
+                # The shared store is an optimization, the event is processed if it cannot be reached
+                logging.info("Shared dedup store could not be reached: " + str(e))
+
+        with self._lock:
+            self._stats["misses"] += 1
+        return None
+
+    def remember(self, resourceUri: str):
+        # Mark a resource as tagged, its own events within the TTL are then duplicates
+        self._seen.put("resource:" + resourceUri.lower(), True)
+
+    def release(self, body: dict, sharedContainer: any = None):
+        """ Forget a claimed event, e.g. because processing failed and a retry should run. """
+        keys = self._keys(body)
+        self._seen.invalidate([key for kind, key in keys.items() if key and kind != "resource"])
+        with self._lock:
+            self._stats["released"] += 1
+
+        if sharedContainer is not None and keys["resourceOperation"]:
+            documentId = _documentId(keys["resourceOperation"])
+            from azure.cosmos.exceptions import CosmosResourceNotFoundError
+            try:
+                sharedContainer.delete_item(item=documentId, partition_key=documentId)
+            except CosmosResourceNotFoundError:
+                pass
+            except Exception as e:
+                logging.info("Shared dedup store could not be reached: " + str(e))
+
+    def clear(self):
+        # Forget every key held in memory. The shared container is left alone.
+        self._seen.invalidate()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
+
+
+def _documentId(key: str) -> str:
+    # Resource ids contain '/', which CosmosDB does not allow in document ids
+    return hashlib.sha256(key.encode("utf-8")).hexdigest()
+
+
+# Worker wide deduper shared by the sync and async pipelines
+eventDeduper = EventDeduper(
+    int(os.environ.get("DEDUP_CACHE_SIZE", "4096")),
+    float(os.environ.get("DEDUP_TTL", "60"))
+)
@@ -0,0 +1,101 @@
+import json
+import time
+import threading
+from collections import deque
+
+# Queue AutoTagTrigger sends events to. It is also the queueName of the AutoTagQueueTrigger
+# binding, keep the two in sync.
+QUEUE_NAME = "autotag-events"
+
+
+def queueMessage(event: dict) -> str:
+    # Events are wrapped with the time they were accepted so the worker can tell which events
+    # are already covered by a later run for the same resource
+    return json.dumps({"enqueuedAt": time.time(), "event": event})
+
+
+class StorageEventQueue:
+    """ EventGrid events queued on an Azure Storage Queue, e.g. on Azurite when running locally.
+
+        Messages are base64 encoded, which is what the queue trigger binding expects by default. """
+
+    def __init__(self, connectionString: str, queueName: str):
+        # Imported here so functions that never queue events do not load the SDK
+        from azure.storage.queue import QueueClient, TextBase64EncodePolicy, TextBase64DecodePolicy
+        self._client = QueueClient.from_connection_string(
+            connectionString,
+            queueName,
+            message_encode_policy=TextBase64EncodePolicy(),
+            message_decode_policy=TextBase64DecodePolicy()
+        )
+
+    def send(self, event: dict, delay: int = 0):
+        # The message stays invisible for delay seconds, giving duplicates time to arrive
+        self._client.send_message(queueMessage(event), visibility_timeout=delay or None)
+
+    def close(self):
+        self._client.close()
+
+
+class InProcessEventQueue:
+    """ In memory stand-in for StorageEventQueue, for tests and local runs without a storage account.
+
+        Delays are ignored, receive returns messages in the order they were sent. """
+
+    def __init__(self):
+        self._messages = deque()
+        self._lock = threading.Lock()
+
+    def send(self, event: dict, delay: int = 0):
+        with self._lock:
+            self._messages.append(queueMessage(event))
+
+    def receive(self, maxMessages: int = 32) -> list:
+        with self._lock:
+            count = min(maxMessages, len(self._messages))
+            return [self._messages.popleft() for _ in range(count)]
+
+    def close(self):
+        pass
+
+
+class Coalescer:
+    """ Remembers when each resource was last processed on this worker.
+
+        An event is covered when its resource was processed after the event was queued, because
+        that run already read the resource in its newer state. Entries older than the window are
+        dropped so memory stays bounded. """
+
+    def __init__(self, window: float):
+        self.window = window
+        self._started = {}
+        self._pruned = time.time()
+        self._lock = threading.Lock()
+        self._stats = {"processed": 0, "coalesced": 0}
+
+    def covered(self, resourceUri: str, enqueuedAt: float) -> bool:
+        with self._lock:
+            started = self._started.get(resourceUri.lower())
+            if started is not None and started >= enqueuedAt:
+                self._stats["coalesced"] += 1
+                return True
+            return False
+
+    def processed(self, resourceUri: str, startedAt: float):
+        # Call once a run for the resource has finished, with the time it started. A run that
+        # raised must not be recorded, its message is retried and would otherwise be covered.
+        now = time.time()
+        with self._lock:
+            self._stats["processed"] += 1
+            key = resourceUri.lower()
+            # Runs can finish out of order, keep the latest start
+            self._started[key] = max(startedAt, self._started.get(key, 0.0))
+            # Prune at most once per window so a storm of events does not rescan the map every time
+            if self._pruned < now - self.window:
+                self._pruned = now
+                for uri in [uri for uri, started in self._started.items() if started < now - self.window]:
+                    del self._started[uri]
+
+    def stats(self) -> dict:
+        with self._lock:
+            return dict(self._stats)
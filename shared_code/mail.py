@@ -0,0 +1,83 @@
+import os
+import logging
+import threading
+
+
+def smtpSettings() -> dict:
+    # Email Appsettings
+    return {
+        "sender": os.environ.get("SENDER_EMAIL_ADDRESS", None),
+        "password": os.environ.get("SENDER_EMAIL_PASSWORD", None),
+        "recipient": os.environ.get("RECEIPIENT_EMAIL_ADDRESS", None),
+        "server": os.environ.get("SMTP_SERVER", None),
+        "port": int(os.environ.get("SMTP_PORT", None) or "25"),
+        "starttls": os.environ.get("SMTP_STARTTLS", "true").lower() == "true",
+    }
+
+
+class SmtpConnection:
+    """ SMTP connection that is kept open and reused for every mail the worker sends.
+
+        EHLO, STARTTLS and login only run when the connection is opened. Before a mail is sent
+        the connection is checked with NOOP and reopened when the server has dropped it.
+        smtplib and the MIME modules are imported on first use, since most invocations never
+        send mail and every import adds to cold start. """
+
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self._server = None
+        self._lock = threading.Lock()
+
+    def send(self, subject: str, message: str):
+        from email.mime.text import MIMEText
+        from email.mime.multipart import MIMEMultipart
+
+        msg = MIMEMultipart()
+        msg['From'] = self.settings["sender"]
+        msg['To'] = self.settings["recipient"]
+        msg['Subject'] = subject
+        msg.attach(MIMEText(message))
+
+        with self._lock:
+            server = self._connection()
+            try:
+                server.sendmail(msg['From'], msg['To'].split(","), msg.as_string())
+            except Exception:
+                # Open a new connection for the next mail
+                self._discard()
+                raise
+
+    def _connection(self):
+        import smtplib
+        if self._server is not None:
+            try:
+                if self._server.noop()[0] == 250:
+                    return self._server
+            except (smtplib.SMTPException, OSError):
+                pass
+            self._discard()
+
+        server = smtplib.SMTP(self.settings["server"], self.settings["port"], timeout=30)
+        # identify ourselves to smtp client
+        server.ehlo()
+        if self.settings["starttls"]:
+            # secure our email with tls encryption
+            server.starttls()
+            # re-identify ourselves as an encrypted connection
+            server.ehlo()
+        if self.settings["password"]:
+            server.login(self.settings["sender"], self.settings["password"])
+        self._server = server
+        return server
+
+    def _discard(self):
+        server, self._server = self._server, None
+        if server is not None:
+            try:
+                server.quit()
+            except Exception as e:
+                logging.info("Error closing SMTP connection: " + str(e))
+
+    def close(self):
+        with self._lock:
+            self._discard()
@@ -0,0 +1,122 @@
+import os
+import time
+import logging
+import threading
+import contextvars
+from contextlib import contextmanager
+
+# OpenTelemetry is optional. When azure-monitor-opentelemetry is installed and
+# APPLICATIONINSIGHTS_CONNECTION_STRING is set, the metrics are exported to Application Insights
+# as custom metrics. Without it, stages are still timed for the debug header and the log.
+# The exporter is set up on the first recorded metric rather than at import, since it is one
+# of the slowest imports of the worker and every function imports this module.
+_otelLock = threading.Lock()
+_otelReady = False
+_durationHistogram = None
+_chargeCounter = None
+
+
+def _instruments() -> tuple:
+    global _otelReady, _durationHistogram, _chargeCounter
+    if _otelReady:
+        return _durationHistogram, _chargeCounter
+    with _otelLock:
+        if not _otelReady:
+            try:
+                from opentelemetry import metrics as otelMetrics
+            except ImportError:
+                otelMetrics = None
+
+            if otelMetrics is not None and os.environ.get("APPLICATIONINSIGHTS_CONNECTION_STRING"):
+                try:
+                    from azure.monitor.opentelemetry import configure_azure_monitor
+                    configure_azure_monitor()
+                except Exception as e:
+                    logging.info("Application Insights metrics exporter could not be configured: " + str(e))
+
+            if otelMetrics is not None:
+                meter = otelMetrics.get_meter("autotagging")
+                _durationHistogram = meter.create_histogram("autotag.stage.duration", unit="ms", description="Duration of a tagging stage")
+                _chargeCounter = meter.create_counter("autotag.cosmos.request_charge", unit="RU", description="CosmosDB request units consumed")
+            _otelReady = True
+    return _durationHistogram, _chargeCounter
+
+# Metrics of the request being handled. Thread pools copy the context per task
+# (see runInContext), so every stage of a request records into the same RequestMetrics.
+_current = contextvars.ContextVar("requestMetrics", default=None)
+
+
+class RequestMetrics:
+    """ Call count, total and slowest duration per stage, and CosmosDB RU charge, for one request. """
+
+    def __init__(self):
+        self.stages = {}
+        self.requestCharge = 0.0
+        self._lock = threading.Lock()
+
+    def record(self, stage: str, milliseconds: float):
+        with self._lock:
+            entry = self.stages.setdefault(stage, {"calls": 0, "ms": 0.0, "maxMs": 0.0})
+            entry["calls"] += 1
+            entry["ms"] += milliseconds
+            entry["maxMs"] = max(entry["maxMs"], milliseconds)
+
+    def charge(self, requestCharge: float):
+        with self._lock:
+            self.requestCharge += requestCharge
+
+    def summary(self) -> dict:
+        with self._lock:
+            return {
+                "stages": {stage: {"calls": entry["calls"], "ms": round(entry["ms"], 1), "maxMs": round(entry["maxMs"], 1)} for stage, entry in self.stages.items()},
+                "cosmosRequestCharge": round(self.requestCharge, 2),
+            }
+
+
+def begin() -> RequestMetrics:
+    """ Start collecting metrics for the current request and return the collector. """
+    requestMetrics = RequestMetrics()
+    _current.set(requestMetrics)
+    return requestMetrics
+
+
+@contextmanager
+def span(stage: str):
+    """ Time a stage, e.g. `with span("tagWrite"): ...`. Failed calls are timed as well. """
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        milliseconds = (time.perf_counter() - started) * 1000
+        requestMetrics = _current.get()
+        if requestMetrics is not None:
+            requestMetrics.record(stage, milliseconds)
+        durationHistogram, _ = _instruments()
+        if durationHistogram is not None:
+            durationHistogram.record(milliseconds, {"stage": stage})
+
+
+def cosmosResponseHook(headers, body):
+    """ response_hook for CosmosDB calls that adds the RU charge of the response to the metrics. """
+    try:
+        requestCharge = float(headers.get("x-ms-request-charge", 0))
+    except (TypeError, ValueError):
+        return
+    requestMetrics = _current.get()
+    if requestMetrics is not None:
+        requestMetrics.charge(requestCharge)
+    _, chargeCounter = _instruments()
+    if chargeCounter is not None:
+        chargeCounter.add(requestCharge)
+
+
+def runInContext(fn):
+    """ Wrap fn so it runs in a copy of the caller's context, for work handed to a thread pool.
+
+        Call it in the submitting thread, e.g. executor.map(runInContext(fn), items). """
+    context = contextvars.copy_context()
+
+    def run(*args):
+        # A context can only be entered by one thread at a time, so each call gets its own copy
+        return context.copy().run(fn, *args)
+    return run
@@ -0,0 +1,124 @@
+import os
+import time
+import atexit
+import logging
+import threading
+from collections import deque
+from datetime import datetime, timezone
+from shared_code.mail import SmtpConnection, smtpSettings
+
+
+class FailureNotifier:
+    """ Collects failures and mails them as one digest per window.
+
+        record only appends to a buffer, so a request never waits for SMTP. A background thread
+        sends the buffered failures once per window over a pooled SMTP connection. During a bad
+        deployment the inbox gets one mail per window, however many resources fail. The buffer
+        is bounded; failures beyond it are counted and reported in the digest. """
+
+    def __init__(self, window: float, maxBuffered: int, settings: dict = None):
+        self.window = window
+        self.settings = settings or smtpSettings()
+        self._failures = deque(maxlen=max(1, maxBuffered))
+        self._dropped = 0
+        self._lock = threading.Lock()
+        self._thread = None
+        self._connection = SmtpConnection(self.settings)
+        self._stats = {"recorded": 0, "dropped": 0, "digests": 0, "sendErrors": 0}
+
+    @property
+    def enabled(self) -> bool:
+        return bool(self.settings["server"] and self.settings["recipient"])
+
+    def record(self, category: str, target: str, error: str):
+        """ Buffer a failure, e.g. record("Tag update", resourceUri, "AppId not found"). """
+        if not self.enabled:
+            return
+        with self._lock:
+            if len(self._failures) == self._failures.maxlen:
+                self._dropped += 1
+                self._stats["dropped"] += 1
+            self._failures.append((datetime.now(timezone.utc), category, target, error))
+            self._stats["recorded"] += 1
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="failure-notifier", daemon=True)
+                self._thread.start()
+
+    def flush(self) -> bool:
+        """ Send the buffered failures now. Returns whether a digest was sent. """
+        with self._lock:
+            failures = list(self._failures)
+            dropped = self._dropped
+            self._failures.clear()
+            self._dropped = 0
+        if not failures:
+            return False
+
+        subject, message = digest(failures, dropped)
+        try:
+            self._connection.send(subject, message)
+        except Exception as e:
+            # The failures are logged where they happened, so a lost digest only costs the mail
+            logging.error("Failure digest could not be sent: " + str(e))
+            with self._lock:
+                self._stats["sendErrors"] += 1
+            return False
+
+        with self._lock:
+            self._stats["digests"] += 1
+        return True
+
+    def _run(self):
+        # One digest per window, started by the first failure
+        while True:
+            time.sleep(self.window)
+            self.flush()
+
+    def configure(self, settings: dict, window: float = None):
+        # Point the notifier at another SMTP server, e.g. a local stand-in in the benchmarks
+        self._connection.close()
+        self.settings = settings
+        self._connection = SmtpConnection(settings)
+        if window is not None:
+            self.window = window
+
+    def close(self):
+        # Send what is buffered and release the SMTP connection, e.g. when the worker shuts down
+        if self.enabled:
+            self.flush()
+        self._connection.close()
+
+    def stats(self) -> dict:
+        with self._lock:
+            stats = dict(self._stats)
+            stats["buffered"] = len(self._failures)
+            return stats
+
+
+def digest(failures: list, dropped: int) -> tuple:
+    """ Subject and plain text body of a digest, with the failures grouped by category. """
+    byCategory = {}
+    for recorded, category, target, error in failures:
+        byCategory.setdefault(category, []).append((recorded, target, error))
+
+    total = len(failures) + dropped
+    subject = "Auto tagging: %d failure%s (%s)" % (total, "" if total == 1 else "s", ", ".join(sorted(byCategory)))
+    lines = ["%d failures between %s and %s UTC." % (total, failures[0][0].strftime("%Y-%m-%d %H:%M:%S"), failures[-1][0].strftime("%Y-%m-%d %H:%M:%S"))]
+    if dropped:
+        lines.append("%d earlier failures did not fit in the buffer, see the function logs." % dropped)
+    for category in sorted(byCategory):
+        lines.append("")
+        lines.append(category + " (" + str(len(byCategory[category])) + "):")
+        for recorded, target, error in byCategory[category]:
+            lines.append("  " + recorded.strftime("%H:%M:%S") + "  " + target + " : " + error)
+    return subject, "\n".join(lines)
+
+
+# Worker wide, every function on the worker adds to the same digest
+failureNotifier = FailureNotifier(
+    float(os.environ.get("NOTIFY_WINDOW", "300")),
+    int(os.environ.get("NOTIFY_MAX_BUFFERED", "500"))
+)
+
+# Best effort: the host may stop the worker without running exit handlers
+atexit.register(failureNotifier.close)
@@ -0,0 +1,149 @@
+import time
+import asyncio
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from azure.core.pipeline.policies import SansIOHTTPPolicy
+from shared_code.metrics import runInContext
+
+# Prefix of the ARM response headers that report how many requests are left in the current window.
+# e.g. x-ms-ratelimit-remaining-subscription-reads: 11999
+#      x-ms-ratelimit-remaining-resource: Microsoft.Compute/HighCostGet3Min;159
+RATELIMIT_HEADER_PREFIX = "x-ms-ratelimit-remaining-"
+
+# Seconds between checks for a free slot when waiting from async code
+ASYNC_POLL_INTERVAL = 0.05
+
+
+class ArmThrottle:
+    """ Adaptive concurrency limit driven by ARM rate limit headers.
+
+        Concurrency grows by one for each response that has plenty of quota left, is halved when
+        the remaining quota drops below the low watermark and is halved with a pause when ARM
+        answers 429 with a Retry-After value. """
+
+    def __init__(self, maxConcurrency: int, lowWatermark: int = 100):
+        self.maxConcurrency = max(1, maxConcurrency)
+        self.lowWatermark = lowWatermark
+        self.limit = self.maxConcurrency
+        self.active = 0
+        self.pausedUntil = 0.0
+        self.throttledResponses = 0
+        self._condition = threading.Condition()
+
+    def acquire(self):
+        with self._condition:
+            while True:
+                wait = self.pausedUntil - time.monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    self.active += 1
+                    return
+                self._condition.wait(timeout=wait if wait > 0 else None)
+
+    async def acquireAsync(self):
+        # Same as acquire without blocking the event loop. Waiters poll instead of waiting on the condition.
+        while True:
+            with self._condition:
+                wait = self.pausedUntil - time.monotonic()
+                if wait <= 0 and self.active < self.limit:
+                    self.active += 1
+                    return
+            await asyncio.sleep(wait if wait > 0 else ASYNC_POLL_INTERVAL)
+
+    def release(self):
+        with self._condition:
+            self.active -= 1
+            self._condition.notify_all()
+
+    def observe(self, statusCode: int, headers):
+        remaining = remainingQuota(headers)
+        with self._condition:
+            if statusCode == 429:
+                self.throttledResponses += 1
+                self.limit = max(1, self.limit // 2)
+                retryAfter = parseRetryAfter(headers.get("Retry-After"))
+                self.pausedUntil = max(self.pausedUntil, time.monotonic() + retryAfter)
+                logging.info("ARM throttled request, concurrency reduced to %d for %ss" % (self.limit, retryAfter))
+            elif remaining is not None and remaining < self.lowWatermark:
+                self.limit = max(1, self.limit // 2)
+            elif self.limit < self.maxConcurrency:
+                self.limit += 1
+            self._condition.notify_all()
+
+
+class ThrottleHeadersPolicy(SansIOHTTPPolicy):
+    """ Pipeline policy that feeds every ARM response, including retried ones, into an ArmThrottle. """
+
+    def __init__(self, throttle: ArmThrottle):
+        super().__init__()
+        self.throttle = throttle
+
+    def on_response(self, request, response):
+        httpResponse = response.http_response
+        self.throttle.observe(httpResponse.status_code, httpResponse.headers)
+
+
+def remainingQuota(headers) -> int:
+    # Return the lowest remaining quota across all rate limit headers, or None if there are none
+    remaining = None
+    for name, value in headers.items():
+        if not name.lower().startswith(RATELIMIT_HEADER_PREFIX):
+            continue
+        # Resource provider headers hold a list of "policy;count" pairs
+        for entry in str(value).split(","):
+            try:
+                count = int(entry.split(";")[-1])
+            except ValueError:
+                continue
+            remaining = count if remaining is None else min(remaining, count)
+    return remaining
+
+
+def parseRetryAfter(value) -> float:
+    try:
+        return max(0.0, float(value))
+    except (TypeError, ValueError):
+        # Fall back to a short pause when the header is missing or is an HTTP date
+        return 5.0
+
+
+def runThrottled(throttle: ArmThrottle, fn, items: list) -> dict:
+    """ Call fn for every item in parallel within the throttle's limit.
+
+        Returns a dictionary of item to exception for every call that failed. """
+    errors = {}
+    errorsLock = threading.Lock()
+
+    def run(item):
+        throttle.acquire()
+        try:
+            fn(item)
+        except Exception as e:
+            with errorsLock:
+                errors[item] = e
+        finally:
+            throttle.release()
+
+    with ThreadPoolExecutor(max_workers=throttle.maxConcurrency) as executor:
+        # Consume the iterator so every call has finished before returning
+        list(executor.map(runInContext(run), items))
+    return errors
+
+
+async def runThrottledAsync(throttle: ArmThrottle, fn, items: list) -> dict:
+    """ Await fn for every item concurrently within the throttle's limit.
+
+        Returns a dictionary of item to exception for every call that failed. """
+    errors = {}
+
+    async def run(item):
+        await throttle.acquireAsync()
+        try:
+            await fn(item)
+        except Exception as e:
+            errors[item] = e
+        finally:
+            throttle.release()
+
+    await asyncio.gather(*[run(item) for item in items])
+    return errors